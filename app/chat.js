@@ -25,10 +25,33 @@ function colorOf(s) {
 }
 
 
+// compact wire format, see server/framing.py
+const FIELD_NAMES = {
+  k: 'key', t: 'create_time', c: 'client_id', m: 'message', r: 'room_id', s: 'status',
+  a: 'action', p: 'args', o: 'kwargs', h: 'phase', e: 'kind',
+};
+const KIND_NAMES = {
+  M: 'MessageEvent', W: 'WsMessageEvent', I: 'IntentEvent', E: 'ErrorEvent', P: 'PresenceEvent', L: 'LifecycleEvent',
+};
+
+function expandEvent(compact) {
+  if (compact.kind) {
+    // the server fell back to plain json
+    return compact;
+  }
+  const event = {};
+  for (const [code, value] of Object.entries(compact)) {
+    event[FIELD_NAMES[code] || code] = value;
+  }
+  event.kind = KIND_NAMES[event.kind] || event.kind;
+  return event;
+}
+
+
 var tabId = sessionStorage.tabId ? sessionStorage.tabId : sessionStorage.tabId = randomString(8);
 
 
-function ChatApp({host='ws://localhost:8000', debug=true, clientId=null}={}) {
+function ChatApp({host='ws://localhost:8000', debug=true, clientId=null, room=null}={}) {
   if (!(this instanceof ChatApp)) {
     throw 'ChatApp requires new keyword';
   }
@@ -40,6 +63,7 @@ function ChatApp({host='ws://localhost:8000', debug=true, clientId=null}={}) {
   if (!this.clientId) {
     this.clientId = randomString(8);
   }
+  this.room = room || decodeURIComponent(location.hash.substring(1)) || 'lobby';
 
 
   function log(m) {
@@ -90,7 +114,7 @@ function ChatApp({host='ws://localhost:8000', debug=true, clientId=null}={}) {
     textarea.disabled = false;
     textarea.placeholder = '';
     textarea.focus();
-    this.sendWsMessage({type: 'open', clientId: this.clientId});
+    this.sendWsMessage({type: 'open', clientId: this.clientId, rooms: [this.room], format: 'compact'});
     while(this.queue.length > 0) {
       webSocket.send(this.queue[0]);
       this.queue = queue.slice(1);
@@ -155,22 +179,37 @@ function ChatApp({host='ws://localhost:8000', debug=true, clientId=null}={}) {
 
   this.onWsMessage = () => {
     try {
-      let message = JSON.parse(event.data);
-      switch (message.kind) {
-        case 'MessageEvent': {
-          let outerDiv = this.createMessageElement({clientId: message.client_id, message: message.message});
-          outerDiv.scrollIntoView({behavior: "smooth", block: "end", inline: "nearest"});
-          break;
-        }
-        default: {
-          log(`unhandled message ${event.data}`);
-        }
+      let payload = JSON.parse(event.data);
+      // a connection that fell behind receives a batch of events in one frame
+      for (let message of Array.isArray(payload) ? payload : [payload]) {
+        this.handleEvent(expandEvent(message));
       }
     } catch {
       log(`unparsable message ${event.data}`);
     }
   }
 
+  this.handleEvent = (message) => {
+    switch (message.kind) {
+      case 'MessageEvent': {
+        let outerDiv = this.createMessageElement({clientId: message.client_id, message: message.message});
+        outerDiv.scrollIntoView({behavior: "smooth", block: "end", inline: "nearest"});
+        break;
+      }
+      case 'PresenceEvent': {
+        log(`${message.client_id} is ${message.status}`);
+        break;
+      }
+      case 'ErrorEvent': {
+        log(`server error: ${message.message}`);
+        break;
+      }
+      default: {
+        log(`unhandled message ${JSON.stringify(message)}`);
+      }
+    }
+  }
+
   function createWebsocket(onerror, onopen, onmessage, onclose) {
     let webSocket = new WebSocket(`${host}/api/chat/ws`);
     webSocket.onerror = onerror;
@@ -199,14 +238,14 @@ function ChatApp({host='ws://localhost:8000', debug=true, clientId=null}={}) {
         }
         this.sendWsMessage({type: 'execute_command', args});
       } else {
-        this.sendWsMessage({type: 'create_message', text: val.trim()});
+        this.sendWsMessage({type: 'create_message', text: val.trim(), room: this.room});
       }
       chatTextarea.value = '';
     }
   });
 
   this.fetchHistory = () => {
-    fetch('/api/chat/history')
+    fetch(`/api/chat/history?room=${encodeURIComponent(this.room)}`)
       .then(r => r.json())
       .then(r => {
         let outerDiv;
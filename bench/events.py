@@ -0,0 +1,67 @@
+"""
+Event allocation benchmark.
+
+Creates MessageEvents the way event.py used to (plain dataclass with a
+`__dict__`, `str(uuid4())` key, `int(time() * 1000)`) and the way it does now
+(slotted dataclass, key and timestamp from `new_key`), reporting creation rate
+and the memory each live event holds.
+
+    python -m bench.events [--events 200000]
+"""
+import argparse
+import dataclasses
+import pathlib
+import sys
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'server'))
+
+from event import MessageEvent
+
+
+@dataclasses.dataclass
+class LegacyMessageEvent:
+    key: str
+    create_time: int
+    client_id: str
+    message: str
+
+    @property
+    def kind(self):
+        return self.__class__.__name__
+
+    @classmethod
+    def of(cls, client_id, message):
+        return cls(str(uuid.uuid4()), int(time.time() * 1000), client_id, message)
+
+
+def measure(cls, n):
+    messages = [f'message {i}' for i in range(n)]
+    start = time.perf_counter()
+    for message in messages:
+        cls.of('bench', message)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    live = [cls.of('bench', message) for message in messages]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del live
+    return n / elapsed, size / n
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=200000)
+    args = parser.parse_args()
+
+    print(f'{"":>8} {"events/s":>12} {"bytes/event":>12}')
+    for name, cls in (('legacy', LegacyMessageEvent), ('slotted', MessageEvent)):
+        rate, size = measure(cls, args.events)
+        print(f'{name:>8} {rate:>12,.0f} {size:>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Fan-out serialization benchmark.
+
+Broadcasts one MessageEvent to N fake sockets the way WsBot used to
+(`send_json(event.as_dict())` per socket, dataclasses.asdict + json.dumps each
+time) and the way it does now (`send_str(event.to_json())`, encoded once).
+
+    python -m bench.fanout [--recipients 10,100,1000,5000] [--rounds 20]
+"""
+import argparse
+import asyncio
+import dataclasses
+import json
+import pathlib
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'server'))
+
+from event import MessageEvent
+from helpers import orjson
+
+
+class FakeWs:
+    def __init__(self):
+        self.sent = 0
+
+    async def send_str(self, data):
+        self.sent += len(data)
+
+    async def send_json(self, data, dumps=json.dumps):
+        await self.send_str(dumps(data))
+
+
+def legacy_as_dict(event):
+    rv = dataclasses.asdict(event)
+    rv.pop('_json', None)
+    rv['kind'] = event.kind
+    return rv
+
+
+async def legacy_fanout(sockets, event):
+    for ws in sockets:
+        await ws.send_json(legacy_as_dict(event))
+
+
+async def cached_fanout(sockets, event):
+    for ws in sockets:
+        await ws.send_str(event.to_json())
+
+
+async def run(recipients, rounds):
+    print(f'encoder: {"orjson" if orjson is not None else "json"}')
+    print(f'{"recipients":>10} {"legacy ms":>10} {"cached ms":>10} {"speedup":>8}')
+    for n in recipients:
+        sockets = [FakeWs() for _ in range(n)]
+        timings = []
+        for fanout in (legacy_fanout, cached_fanout):
+            start = time.perf_counter()
+            for i in range(rounds):
+                await fanout(sockets, MessageEvent.of('bench', f'message number {i} ' * 4))
+            timings.append((time.perf_counter() - start) / rounds * 1000)
+        print(f'{n:>10} {timings[0]:>10.3f} {timings[1]:>10.3f} {timings[0] / timings[1]:>7.1f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--recipients', default='10,100,1000,5000')
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run([int(n) for n in args.recipients.split(',')], args.rounds))
+
+
+if __name__ == '__main__':
+    main()
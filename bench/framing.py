@@ -0,0 +1,44 @@
+"""
+Wire format benchmark.
+
+Encodes a stream of MessageEvents in each format framing.py offers and reports
+bytes per frame, with and without deflate, and encode time. Deflate runs with a
+fresh context per frame, a lower bound for what permessage-deflate saves.
+
+    python -m bench.framing [--events 50000] [--message-size 40]
+"""
+import argparse
+import pathlib
+import sys
+import time
+import zlib
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'server'))
+
+from event import MessageEvent
+from framing import encode
+from framing import formats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=50000)
+    parser.add_argument('--message-size', type=int, default=40)
+    args = parser.parse_args()
+
+    text = ('lorem ipsum dolor sit amet ' * (args.message_size // 27 + 1))[:args.message_size]
+    print(f'{"format":>8} {"bytes":>7} {"deflated":>9} {"encode us":>10}')
+    for fmt in formats():
+        # fresh events, encodings are cached on the event
+        events = [MessageEvent.of(f'client-{i % 100}', text, 'lobby') for i in range(args.events)]
+        start = time.perf_counter()
+        frames = [encode(event, fmt) for event in events]
+        elapsed = time.perf_counter() - start
+        raw = [f.encode() if isinstance(f, str) else f for f in frames]
+        size = sum(len(f) for f in raw) / len(raw)
+        deflated = sum(len(zlib.compress(f)) for f in raw[:5000]) / min(len(raw), 5000)
+        print(f'{fmt:>8} {size:>7.1f} {deflated:>9.1f} {elapsed / len(events) * 1e6:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
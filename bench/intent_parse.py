@@ -0,0 +1,84 @@
+"""
+Intent parsing benchmark.
+
+Runs a mix of chat messages through the parsing TranslatorBot used to do
+(strip, split, `split('=')` per argument, strip again for plain messages) and
+through the command registry with the plain-message fast path.
+
+    python -m bench.intent_parse [--messages 200000] [--intent-ratio 0.1]
+"""
+import argparse
+import pathlib
+import random
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'server'))
+
+import bots  # noqa: F401, declares the commands
+from commands import COMMANDS
+from commands import CommandError
+
+
+def legacy_translate(message):
+    stripped = message.strip()
+    if stripped.startswith('.'):
+        parts = stripped.split()
+        args = []
+        kwargs = {}
+        for arg in parts[1:]:
+            if '=' in arg:
+                kv = arg.split('=')
+                kwargs[kv[0]] = kv[1]
+            else:
+                args.append(arg)
+        return parts[0][1:], args, kwargs
+    elif len(message.strip()) > 0:
+        return message.strip()
+
+
+def registry_translate(message):
+    message = message.strip()
+    if not message:
+        return None
+    if message[0] != '.':
+        return message
+    try:
+        return COMMANDS.parse(message)
+    except CommandError as e:
+        return e
+
+
+def corpus(n, intent_ratio, seed=7):
+    rng = random.Random(seed)
+    intents = ['.createBot QuestionBot', '.setIntent greeting', '.getState', '.ASK',
+               '.createBot bot=IntentRecorderBot', '.nope 1 2 3']
+    chat = ['hello there', '  how is everyone doing today?  ', 'lol', 'a' * 200,
+            'meeting at 3pm, room 4', '']
+    return [rng.choice(intents) if rng.random() < intent_ratio else rng.choice(chat) for _ in range(n)]
+
+
+def timed(fn, messages):
+    start = time.perf_counter()
+    for message in messages:
+        fn(message)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--intent-ratio', type=float, default=0.1)
+    args = parser.parse_args()
+
+    print(f'{"intents":>8} {"legacy msg/s":>14} {"registry msg/s":>15} {"speedup":>8}')
+    for ratio in sorted({0.0, args.intent_ratio, 1.0}):
+        messages = corpus(args.messages, ratio)
+        legacy = timed(legacy_translate, messages)
+        registry = timed(registry_translate, messages)
+        print(f'{ratio:>8.0%} {len(messages) / legacy:>14,.0f} {len(messages) / registry:>15,.0f} '
+              f'{legacy / registry:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Benchmark for turning fetched rows into ORM entities.
+
+Compares the old hydration, `cls(**record)` through the O(n^2) table_init
+into instance __dict__s, with the slotted entities Meta builds now, filled by
+the per table compiled `_from_record`. Reports the time to hydrate the rows,
+the time to read one column off each entity and the memory the entities keep
+alive once the fetched list is gone (tracemalloc).
+
+Rows are asyncpg Records shaped like message rows, built with the helper
+asyncpg's own tests use, or fetched from AIO_CONFIG postgres with --live. The
+rows are made inside the traced window and the list is dropped before the
+measurement, so only what the entities keep alive is counted.
+
+    python -m bench.orm_hydration [--rows N] [--live]
+"""
+import argparse
+import asyncio
+import datetime
+import gc
+import json
+import os
+import pathlib
+import sys
+import tracemalloc
+from time import perf_counter
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'server'))
+
+from db.orm import Column
+from db.orm import Meta
+
+
+class BenchMessage(metaclass=Meta):
+    _table      = 'message'
+    id          = Column(primary_key=True)
+    create_time = Column
+    client_id   = Column
+    value       = Column
+    room_id     = Column
+
+
+class LegacyMessage:
+    """
+    The entity as Meta used to build it, one attribute per column in __dict__.
+    """
+    table_meta = BenchMessage.table_meta
+
+    def __init__(self, *args, **kwargs):
+        unused_attr = list(self.table_meta.name_attr.values())
+        for k, v in kwargs.items():
+            attr = self.table_meta.name_attr.get(k)
+            if attr:
+                setattr(self, attr, v)
+                unused_attr.remove(attr)
+        for k in unused_attr:
+            setattr(self, k, None)
+
+
+_FIELDS = {'id': 0, 'create_time': 1, 'client_id': 2, 'value': 3, 'room_id': 4}
+
+
+def fake_rows(n):
+    from asyncpg.protocol.protocol import _create_record
+
+    now = datetime.datetime.now()
+    return [_create_record(_FIELDS, (i, now, f'client-{i % 100}', f'message {i}', 'lobby')) for i in range(n)]
+
+
+async def fetch_rows(n):
+    import asyncpg
+
+    with open(os.environ['AIO_CONFIG'], 'r') as f:
+        config = json.load(f)
+    conn = await asyncpg.connect(**config['db'])
+    try:
+        return await conn.fetch('''
+            SELECT i AS id, now()::timestamp AS create_time, 'client-' || (i % 100) AS client_id,
+                   'message ' || i AS value, 'lobby' AS room_id
+            FROM generate_series(1, $1) AS i
+        ''', n)
+    finally:
+        await conn.close()
+
+
+def bench(name, hydrate, make_rows):
+    rows = make_rows()
+    gc.collect()
+    start = perf_counter()
+    entities = hydrate(rows)
+    hydrate_s = perf_counter() - start
+    start = perf_counter()
+    for e in entities:
+        e.value
+    read_s = perf_counter() - start
+    n = len(entities)
+    del rows, entities
+
+    # memory in a second pass, tracing slows allocation down
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    rows = make_rows()
+    entities = hydrate(rows)
+    # the fetched list goes away, whatever the entities reference stays
+    del rows
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del entities
+    print(f'{name:<10} hydrate {hydrate_s / n * 1e9:6.0f} ns/row   read {read_s / n * 1e9:4.0f} ns/row'
+          f'   retained {retained / n:6.0f} B/row')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--live', action='store_true', help='hydrate asyncpg Records from AIO_CONFIG postgres')
+    args = parser.parse_args()
+    if args.live:
+        make_rows = lambda: asyncio.run(fetch_rows(args.rows))
+    else:
+        make_rows = lambda: fake_rows(args.rows)
+    bench('legacy', lambda rows: [LegacyMessage(**r) for r in rows], make_rows)
+    bench('slotted', lambda rows: list(map(BenchMessage._from_record, rows)), make_rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Micro-benchmark for ORM statement generation.
+
+Compares the per-call f-string building the ORM used to do for create/update
+with the statement cache on TableMeta. With AIO_CONFIG set it also times
+`create` round trips against Postgres with and without prepared statements.
+
+    python -m bench.orm_statements [--iterations N] [--live]
+"""
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import sys
+import timeit
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'server'))
+
+from db.orm import Column
+from db.orm import Meta
+from db.orm import _create_sql
+from db.orm import _update_sql
+
+
+class BenchData(metaclass=Meta):
+    id          = Column(primary_key=True)
+    created     = Column(name='create_time')
+    data        = Column
+    owner       = Column
+
+
+class PreparedBenchData(metaclass=Meta):
+    _prepare    = True
+    id          = Column(primary_key=True)
+    created     = Column(name='create_time')
+    data        = Column
+    owner       = Column
+
+
+def legacy_create_sql(table_meta, kwargs):
+    given_cols = [given_key for given_key in kwargs.keys() if given_key in table_meta.col_map]
+    return f'INSERT INTO {table_meta.name} ({",".join(given_cols)}) VALUES ($1{"".join([f",${i}" for i in range(2, len(given_cols) + 1)])}) RETURNING *'
+
+
+def legacy_update_sql(table_meta, pk, kwargs):
+    set_sql = []
+    var_list = []
+    for k, v in kwargs.items():
+        if k in table_meta.col_map:
+            col = table_meta.col_map.get(k)
+            set_sql.append(f'{col.name}=${len(var_list) + 1}')
+            var_list.append(v)
+    return f'UPDATE {table_meta.name} SET {", ".join(set_sql)} WHERE {table_meta.pk.name}={pk} RETURNING *'
+
+
+def cached_create_sql(table_meta, kwargs):
+    given_cols = tuple(k for k in kwargs.keys() if k in table_meta.col_map)
+    return table_meta.statement(('create', given_cols), _create_sql, table_meta, given_cols)
+
+
+def cached_update_sql(table_meta, kwargs):
+    given_cols = tuple(k for k in kwargs.keys() if k in table_meta.col_map)
+    return table_meta.statement(('update', given_cols), _update_sql, table_meta, given_cols)
+
+
+def bench_statements(iterations):
+    meta = BenchData.table_meta
+    kwargs = {'data': 'hello', 'owner': 'bench'}
+    cases = [
+        ('create legacy', lambda: legacy_create_sql(meta, kwargs)),
+        ('create cached', lambda: cached_create_sql(meta, kwargs)),
+        ('update legacy', lambda: legacy_update_sql(meta, 42, kwargs)),
+        ('update cached', lambda: cached_update_sql(meta, kwargs)),
+    ]
+    for name, fn in cases:
+        elapsed = timeit.timeit(fn, number=iterations)
+        print(f'{name:<16} {elapsed / iterations * 1e9:8.0f} ns/op')
+
+
+async def bench_live(iterations):
+    import asyncpg
+
+    with open(os.environ['AIO_CONFIG'], 'r') as f:
+        config = json.load(f)
+    conn = await asyncpg.connect(**config['db'])
+    try:
+        for clz in (BenchData, PreparedBenchData):
+            name = clz.table_meta.name
+            await conn.execute(f'DROP TABLE IF EXISTS {name}')
+            await conn.execute(f'''CREATE TABLE {name} (id SERIAL PRIMARY KEY,
+                                   create_time TIMESTAMP DEFAULT now(), data VARCHAR, owner VARCHAR)''')
+            loop = asyncio.get_event_loop()
+            start = loop.time()
+            for _ in range(iterations):
+                await clz.create(conn, data='hello', owner='bench')
+            elapsed = loop.time() - start
+            print(f'{clz.__name__:<20} {elapsed / iterations * 1e6:8.1f} us/create')
+            await conn.execute(f'DROP TABLE {name}')
+    finally:
+        await conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200000)
+    parser.add_argument('--live', action='store_true', help='also run create() against AIO_CONFIG postgres')
+    args = parser.parse_args()
+    bench_statements(args.iterations)
+    if args.live:
+        asyncio.run(bench_live(min(args.iterations, 5000)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+"""
+WebSocket load generator for /api/chat/ws.
+
+Opens `--clients` sockets that speak the chat protocol (`open`, then
+`create_message`), each sending `--messages` messages at `--rate` per second.
+Clients are spread over `--rooms` rooms and see every message of their room,
+latency is measured on the copies of a client's own messages coming back. Reports end-to-end latency percentiles,
+delivered messages/sec and server RSS.
+
+    # against a running server
+    python -m bench.ws_load --url http://127.0.0.1:8000 --clients 500
+
+    # spawn a server with the database stubbed out, fail on regressions
+    python -m bench.ws_load --spawn --stub-db --clients 2000 --max-p99-ms 250 --min-rate 50000
+"""
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+SERVER_DIR = pathlib.Path(__file__).parent.parent / 'server'
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.connected = 0
+        self.rx_bytes = 0
+        # perf_counter of the last send or delivery, the run ends there
+        self.last_at = None
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    idx = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[idx]
+
+
+async def run_client(session, url, idx, args, stats, start_gate):
+    client_id = f'bench-{idx}'
+    pending = {}
+    if args.format == 'json':
+        kind, message_kind, client, message = 'kind', 'MessageEvent', 'client_id', 'message'
+    else:
+        kind, message_kind, client, message = 'e', 'M', 'c', 'm'
+    try:
+        async with session.ws_connect(f'{url}/api/chat/ws', max_msg_size=0, compress=args.compress) as ws:
+            room = 'lobby' if args.rooms == 1 else f'room-{idx % args.rooms}'
+            await ws.send_json({'type': 'open', 'clientId': client_id, 'rooms': [room], 'format': args.format})
+            stats.connected += 1
+
+            async def receive():
+                async for msg in ws:
+                    if msg.type == aiohttp.WSMsgType.TEXT:
+                        payload = json.loads(msg.data)
+                    elif msg.type == aiohttp.WSMsgType.BINARY:
+                        payload = msgpack.unpackb(msg.data)
+                    else:
+                        continue
+                    # payload size, not wire size, when compressed
+                    stats.rx_bytes += len(msg.data)
+                    for event in payload if isinstance(payload, list) else [payload]:
+                        if event.get(kind) != message_kind:
+                            continue
+                        stats.received += 1
+                        stats.last_at = time.perf_counter()
+                        if event[client] == client_id:
+                            sent_at = pending.pop(event[message], None)
+                            if sent_at is not None:
+                                stats.latencies.append(time.perf_counter() - sent_at)
+                    if not pending and sending.done():
+                        return
+
+            sending = asyncio.get_event_loop().create_future()
+            receiver = asyncio.create_task(receive())
+            await start_gate.wait()
+            interval = 1.0 / args.rate
+            for seq in range(args.messages):
+                text = f'{client_id}:{seq}'
+                pending[text] = time.perf_counter()
+                await ws.send_json({'type': 'create_message', 'text': text, 'room': room})
+                stats.sent += 1
+                stats.last_at = max(stats.last_at or 0, time.perf_counter())
+                await asyncio.sleep(interval)
+            sending.set_result(None)
+            if pending:
+                try:
+                    await asyncio.wait_for(receiver, args.drain_timeout)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                # every echo came back during the send loop, nothing would wake the receiver
+                receiver.cancel()
+    except Exception as e:
+        stats.errors += 1
+        if stats.errors <= 5:
+            print(f'client {idx} failed: {e!r}', file=sys.stderr)
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def spawn_server(args):
+    config = {}
+    if os.environ.get('AIO_CONFIG'):
+        with open(os.environ['AIO_CONFIG'], 'r') as f:
+            config = json.load(f)
+    if args.stub_db:
+        config['db'] = {'stub': True}
+    config['log_level'] = 'WARNING'
+    config_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+    json.dump(config, config_file)
+    config_file.close()
+
+    env = dict(os.environ, AIO_CONFIG=config_file.name)
+    proc = subprocess.Popen(
+        [sys.executable, 'app.py', '--host', '127.0.0.1', '--port', str(args.port), '--workers', str(args.workers)],
+        cwd=SERVER_DIR, env=env, stdout=subprocess.DEVNULL)
+    return proc, config_file.name
+
+
+async def wait_healthy(session, url, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(f'{url}/api/health') as resp:
+                if resp.status == 200:
+                    return await resp.json()
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f'server at {url} did not become healthy')
+
+
+def process_rss(pid):
+    """
+    RSS of `pid` and its children (the pre-forked workers), from /proc.
+    """
+    total = 0
+    pids = [pid]
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children', 'r') as f:
+            pids.extend(int(p) for p in f.read().split())
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            with open(f'/proc/{p}/status', 'r') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total or None
+
+
+async def run(args):
+    raise_fd_limit()
+    proc = None
+    config_path = None
+    url = args.url
+    if args.spawn:
+        proc, config_path = spawn_server(args)
+        url = f'http://127.0.0.1:{args.port}'
+
+    stats = Stats()
+    connector = aiohttp.TCPConnector(limit=0)
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            health = await wait_healthy(session, url)
+            rss_before = process_rss(proc.pid) if proc else health.get('rss_bytes')
+
+            start_gate = asyncio.Event()
+            clients = []
+            for idx in range(args.clients):
+                clients.append(asyncio.create_task(run_client(session, url, idx, args, stats, start_gate)))
+                if args.ramp and idx % 100 == 99:
+                    await asyncio.sleep(args.ramp)
+            while stats.connected + stats.errors < args.clients:
+                await asyncio.sleep(0.05)
+
+            started = time.perf_counter()
+            start_gate.set()
+            rss_peak = rss_before or 0
+            while not all(c.done() for c in clients):
+                await asyncio.sleep(0.25)
+                if proc:
+                    rss_peak = max(rss_peak, process_rss(proc.pid) or 0)
+            # up to the last send or delivery, not to the end of the drain timeout
+            elapsed = (stats.last_at or time.perf_counter()) - started
+            if not proc:
+                rss_peak = (await wait_healthy(session, url)).get('rss_bytes')
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait(timeout=30)
+            os.unlink(config_path)
+
+    latencies = sorted(stats.latencies)
+    expected = stats.sent
+    result = {
+        'clients': args.clients,
+        'rooms': args.rooms,
+        'connected': stats.connected,
+        'errors': stats.errors,
+        'sent': stats.sent,
+        'own_received': len(latencies),
+        'lost': expected - len(latencies),
+        'delivered': stats.received,
+        'elapsed_s': round(elapsed, 3),
+        'send_rate': round(stats.sent / elapsed, 1),
+        'delivery_rate': round(stats.received / elapsed, 1),
+        'rx_bytes_per_event': round(stats.rx_bytes / stats.received, 1) if stats.received else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p90_ms': round(percentile(latencies, 90) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'max_ms': round(latencies[-1] * 1000, 2) if latencies else None,
+        'rss_before_mb': round(rss_before / 2 ** 20, 1) if rss_before else None,
+        'rss_peak_mb': round(rss_peak / 2 ** 20, 1) if rss_peak else None,
+    }
+    return result
+
+
+def check_thresholds(result, args):
+    failures = []
+    if args.max_p99_ms is not None and not result['p99_ms'] <= args.max_p99_ms:
+        failures.append(f'p99 {result["p99_ms"]}ms > {args.max_p99_ms}ms')
+    if args.min_rate is not None and result['delivery_rate'] < args.min_rate:
+        failures.append(f'delivery rate {result["delivery_rate"]}/s < {args.min_rate}/s')
+    if args.max_rss_mb is not None and result['rss_peak_mb'] and result['rss_peak_mb'] > args.max_rss_mb:
+        failures.append(f'rss {result["rss_peak_mb"]}MB > {args.max_rss_mb}MB')
+    if args.max_lost is not None and result['lost'] > args.max_lost:
+        failures.append(f'{result["lost"]} messages lost > {args.max_lost}')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=10, help='messages per client')
+    parser.add_argument('--rooms', type=int, default=1, help='rooms the clients are spread over')
+    parser.add_argument('--format', choices=('json', 'compact', 'msgpack'), default='json',
+                        help='wire format asked for at open')
+    parser.add_argument('--compress', type=int, default=0, help='permessage-deflate window bits, 0 is off')
+    parser.add_argument('--rate', type=float, default=2.0, help='messages per second per client')
+    parser.add_argument('--ramp', type=float, default=0.05, help='pause after every 100 connects')
+    parser.add_argument('--drain-timeout', type=float, default=10.0)
+    parser.add_argument('--spawn', action='store_true', help='start a server for the run')
+    parser.add_argument('--stub-db', action='store_true', help='spawned server uses the stub database')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print the result as json')
+    parser.add_argument('--max-p99-ms', type=float)
+    parser.add_argument('--min-rate', type=float, help='minimum delivered messages/sec')
+    parser.add_argument('--max-rss-mb', type=float)
+    parser.add_argument('--max-lost', type=int)
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(result))
+    else:
+        for k, v in result.items():
+            print(f'{k:>18}: {v}')
+    failures = check_thresholds(result, args)
+    for failure in failures:
+        print(f'REGRESSION: {failure}', file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,4 @@
+#!/bin/bash
+# runs once when the primary's data directory is initialised
+set -e
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
@@ -1,23 +1,37 @@
+import argparse
 import pathlib
 import json
 import logging
 import sys
 import os
+import tempfile
+import time
 from uuid import uuid4 as uuid
 
 from aiohttp import web
-import asyncpg
 import uvloop
 
+from broadcast import BroadcastHub
 from bots import HistoryBot
+from bots import RecentHistoryBot
 from bots import TranslatorBot
 from bots import SystemBot
 from bots import EchoBot
 from chat import init_app
 from db.migration import migrate
+from db.partitions import PartitionMaintainer
+from db.pool import InstrumentedPool
+from db.pool import create_pools
+from db.stub import StubPool
 from dispatch import Dispatcher
+from launcher import Master
+from sessions import SessionRegistry
+from metrics import REGISTRY
+from transport import create_transport
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger(__name__)
 
-logging.basicConfig(level=logging.DEBUG)
 
 async def get_index(request):
     return web.Response(status=301, headers={'location': '/app/index.html'})
@@ -25,24 +39,84 @@ async def get_index(request):
 
 async def create_pgengine(app):
     config = app['config']
-    app['pgpool'] = await asyncpg.create_pool(**config['db'])
+    if config['db'].get('stub'):
+        LOG.warning('running with the stub database, nothing is persisted')
+        app['pgpool'] = app['pgpool_ro'] = StubPool()
+        return
+    primary, replica = await create_pools(config)
+    app['pgpool'] = primary
+    # reads that can stand replication lag, history and search
+    app['pgpool_ro'] = replica or primary
     await migrate(app['pgpool'])
 
 
 async def dispose_pgengine(app):
-    app['pg_engine'].close()
-    await app['pg_engine'].wait_closed()
+    if app['pgpool_ro'] is not app['pgpool']:
+        await app['pgpool_ro'].close()
+    await app['pgpool'].close()
+
+
+async def start_partition_maintenance(app):
+    if app['config']['db'].get('stub'):
+        return
+    config = app['config'].get('history', {})
+    retention_days = config.get('retention_days')
+    maintainer = PartitionMaintainer(
+        app['pgpool'],
+        days_ahead=int(config.get('partition_days_ahead', 7)),
+        retention_days=int(retention_days) if retention_days is not None else None,
+        interval=float(config.get('partition_interval', 3600)))
+    maintainer.start()
+    app['partitions'] = maintainer
+
+
+async def stop_partition_maintenance(app):
+    if 'partitions' in app:
+        await app['partitions'].close()
 
 
 def setup_db(app):
     app.on_startup.append(create_pgengine)
+    app.on_startup.append(start_partition_maintenance)
+    app.on_shutdown.append(stop_partition_maintenance)
     app.on_cleanup.append(dispose_pgengine)
 
 def setup_bots(app):
+    async def create_broadcast_hub(app):
+        dispatcher = app['dispatcher']
+        config = app['config'].get('broadcast', {})
+        hub = BroadcastHub(
+            max_pending=int(config.get('max_pending', 256)),
+            policy=config.get('policy', 'drop'))
+        hub.init(dispatcher)
+        app['hub'] = hub
+        sessions = SessionRegistry()
+        sessions.init(dispatcher)
+        app['sessions'] = sessions
+
+    async def close_broadcast_hub(app):
+        await app['hub'].close()
+
     async def create_history_bot(app):
         dispatcher = app['dispatcher']
-        bot = HistoryBot(app['pgpool'])
+        config = app['config'].get('history', {})
+        bot = HistoryBot(
+            app['pgpool'],
+            batch_size=int(config.get('batch_size', 500)),
+            flush_interval=float(config.get('flush_interval', 0.25)))
+        bot.init(dispatcher)
+        app['history_bot'] = bot
+
+    async def create_recent_history_bot(app):
+        dispatcher = app['dispatcher']
+        config = app['config'].get('history', {})
+        bot = RecentHistoryBot(app['pgpool'], size=int(config.get('recent_size', 1000)))
+        await bot.warm()
         bot.init(dispatcher)
+        app['recent_history'] = bot
+
+    async def close_history_bot(app):
+        await app['history_bot'].close()
 
     async def create_translator_bot(app):
         dispatcher = app['dispatcher']
@@ -59,10 +133,16 @@ def setup_bots(app):
         bot = EchoBot(app)
         bot.init(dispatcher)
 
+    app.on_startup.append(create_broadcast_hub)
     app.on_startup.append(create_history_bot)
+    app.on_startup.append(create_recent_history_bot)
     app.on_startup.append(create_translator_bot)
     app.on_startup.append(create_system_bot)
     app.on_startup.append(create_echo_bot)
+    # setup_dispatch registers stop_dispatcher before these, the lanes are
+    # drained by the time the history bot does its last flush
+    app.on_shutdown.append(close_broadcast_hub)
+    app.on_shutdown.append(close_history_bot)
 
 def setup_routes(app):
     app.router.add_get('/', get_index)
@@ -71,7 +151,7 @@ def setup_routes(app):
     app.router.add_static('/app', str(pathlib.Path(__file__).parent.parent) + "/app", show_index=False)
 
 
-def setup_config(app):
+def load_config():
     cfg = {}
     config = os.environ.get('AIO_CONFIG')
     if config:
@@ -80,27 +160,190 @@ def setup_config(app):
     for key in os.environ.keys():
         k = key.lower()
         if k.startswith('aio_') and k != 'aio_config':
-            config[k[4:]] = os.environ.get(key)
-    app['config'] = cfg
+            cfg[k[4:]] = os.environ.get(key)
+    return cfg
+
+
+def setup_config(app, config=None):
+    app['config'] = config if config is not None else load_config()
+    logging.getLogger().setLevel(app['config'].get('log_level', 'INFO'))
+
+
+async def get_health(request):
+    return web.json_response(health_status(request.app))
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def health_status(app):
+    dispatcher = app['dispatcher']
+    hub = app.get('hub')
+    return {
+        'pid': os.getpid(),
+        'worker': app['worker'],
+        'uptime_s': round(time.monotonic() - app['start_time'], 1),
+        'connections': hub.connection_count if hub else 0,
+        # the report also goes through the launcher's pipe, keep it small
+        'slow_connections': hub.slowest() if hub else [],
+        'clients': len(app['sessions']) if 'sessions' in app else 0,
+        'rss_bytes': rss_bytes(),
+        'queued': dispatcher.depth,
+        'dispatch': dispatcher.stats,
+        'db': {pool.name: pool.stats() for pool in db_pools(app)},
+    }
+
+
+def db_pools(app):
+    pools = []
+    for key in ('pgpool', 'pgpool_ro'):
+        pool = app.get(key)
+        if isinstance(pool, InstrumentedPool) and pool not in pools:
+            pools.append(pool)
+    return pools
+
+
+async def get_metrics(request):
+    return web.Response(text=REGISTRY.render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Prometheus-Format': '0.0.4'})
+
+
+def collect_app_stats(app):
+    def collect():
+        hub = app.get('hub')
+        if hub is not None:
+            stats = hub.stats()
+            yield ('aiochat_ws_connections', 'gauge', 'Open websocket connections', [({}, stats['connections'])])
+            yield ('aiochat_ws_rooms', 'gauge', 'Rooms with at least one member here', [({}, stats['rooms'])])
+            yield ('aiochat_ws_queued_frames', 'gauge', 'Frames waiting on connection writers', [({}, stats['queued'])])
+            yield ('aiochat_ws_max_queued_frames', 'gauge', 'Deepest connection backlog', [({}, stats['max_queued'])])
+            yield ('aiochat_ws_sent_frames_total', 'counter', 'Events written to websockets', [({}, stats['sent'])])
+            yield ('aiochat_ws_dropped_frames_total', 'counter', 'Events dropped for slow consumers', [({}, stats['dropped'])])
+            # per connection numbers are in /api/health, a label per socket would not scale
+            yield ('aiochat_ws_max_connection_dropped_frames', 'gauge', 'Most frames dropped for one open connection',
+                   [({}, max((c['dropped'] for c in stats['per_connection']), default=0))])
+        sessions = app.get('sessions')
+        if sessions is not None:
+            yield ('aiochat_online_clients', 'gauge', 'Distinct client_ids connected', [({}, len(sessions))])
+        history = app.get('history_bot')
+        if history is not None:
+            stats = history.stats
+            yield ('aiochat_history_flushes_total', 'counter', 'Message batches written', [({}, stats['flushes'])])
+            yield ('aiochat_history_rows_total', 'counter', 'Messages written', [({}, stats['rows'])])
+            yield ('aiochat_history_flush_failures_total', 'counter', 'Failed flushes, retried', [({}, stats['flush_failures'])])
+            yield ('aiochat_history_failed_rows_total', 'counter', 'Messages lost to failed flushes', [({}, stats['failed_rows'])])
+            yield ('aiochat_history_last_batch_size', 'gauge', 'Rows in the last flush', [({}, stats['last_batch_size'])])
+            yield ('aiochat_history_last_flush_seconds', 'gauge', 'Duration of the last flush', [({}, stats['last_flush_ms'] / 1000)])
+        pools = [(pool.name, pool.stats()) for pool in db_pools(app)]
+        if pools:
+            yield ('aiochat_db_pool_size', 'gauge', 'Open pooled connections', [({'pool': n}, s['size']) for n, s in pools])
+            yield ('aiochat_db_pool_max_size', 'gauge', 'Pool size limit', [({'pool': n}, s['max_size']) for n, s in pools])
+            yield ('aiochat_db_pool_in_use', 'gauge', 'Connections acquired', [({'pool': n}, s['in_use']) for n, s in pools])
+            yield ('aiochat_db_pool_waiting', 'gauge', 'Acquires waiting for a connection', [({'pool': n}, s['waiting']) for n, s in pools])
+            yield ('aiochat_db_pool_saturation', 'gauge', 'Connections in use over the size limit', [({'pool': n}, s['saturation']) for n, s in pools])
+        partitions = app.get('partitions')
+        if partitions is not None:
+            stats = partitions.stats
+            yield ('aiochat_partitions_created_total', 'counter', 'Message partitions created', [({}, stats['created'])])
+            yield ('aiochat_partitions_dropped_total', 'counter', 'Message partitions dropped by retention', [({}, stats['dropped'])])
+            yield ('aiochat_partition_maintenance_failures_total', 'counter', 'Failed maintenance runs', [({}, stats['failures'])])
+        recent = app.get('recent_history')
+        if recent is not None:
+            yield ('aiochat_recent_history_requests_total', 'counter', 'History requests by buffer outcome',
+                   [({'result': 'hit'}, recent.stats['hits']), ({'result': 'miss'}, recent.stats['misses'])])
+    return collect
+
+
+def setup_metrics(app):
+    async def register_collectors(app):
+        app['metrics_collector'] = collect_app_stats(app)
+        REGISTRY.register_collector(app['metrics_collector'])
+
+    async def unregister_collectors(app):
+        REGISTRY.unregister_collector(app['metrics_collector'])
+
+    app.router.add_get('/metrics', get_metrics)
+    app.on_startup.append(register_collectors)
+    app.on_cleanup.append(unregister_collectors)
+
+
+def setup_health(app, worker):
+    app['worker'] = worker
+    app['start_time'] = time.monotonic()
+    app.router.add_get('/api/health', get_health)
 
 
 async def start_dispatcher(app):
-    app['dispatcher'].start()
+    transport = create_transport(app['config'].get('transport', {}), app.get('pgpool'))
+    await app['dispatcher'].open(transport)
+
+
+async def stop_dispatcher(app):
+    config = app['config'].get('dispatch', {})
+    await app['dispatcher'].close(drain_timeout=float(config.get('drain_timeout', 5.0)))
 
 def setup_dispatch(app):
-    dispatcher = Dispatcher()
+    config = app['config'].get('dispatch', {})
+    dispatcher = Dispatcher(
+        max_queue=int(config.get('max_queue', 10000)),
+        overload=config.get('overload', 'block'),
+        workers=int(config.get('workers', 4)),
+        mode=config.get('mode', 'sharded'),
+        handler_timeout=float(config.get('handler_timeout', 5.0)),
+        max_background=int(config.get('max_background', 256)),
+        breaker_threshold=int(config.get('breaker_threshold', 5)),
+        breaker_reset=float(config.get('breaker_reset', 30.0)),
+        shared_kinds=app['config'].get('transport', {}).get(
+            'shared_kinds', ('MessageEvent', 'IntentEvent', 'PresenceEvent')))
     app['dispatcher'] = dispatcher
     app.on_startup.append(start_dispatcher)
+    app.on_shutdown.append(stop_dispatcher)
+
+
+def create_app(config=None, worker=None):
+    app = web.Application()
+    setup_config(app, config)
+    setup_routes(app)
+    setup_health(app, worker)
+    setup_metrics(app)
+    setup_db(app)
+    setup_dispatch(app)
+    setup_bots(app)
+    return app
+
+
+app = create_app()
+
+
+def main():
+    config = load_config()
+    server = config.get('server', {})
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default=server.get('host', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(server.get('port', 8000)))
+    parser.add_argument('--workers', type=int, default=int(server.get('workers', 1)),
+                        help='fork this many worker processes sharing the port with SO_REUSEPORT')
+    args = parser.parse_args()
 
+    if args.workers <= 1:
+        uvloop.install()
+        web.run_app(create_app(config), host=args.host, port=args.port)
+        return
 
-app = web.Application()
-setup_config(app)
-setup_routes(app)
-setup_db(app)
-setup_dispatch(app)
-setup_bots(app)
+    broker_path = None
+    transport = config.get('transport', {})
+    if transport.get('type', 'memory') == 'memory':
+        # workers have to share one event stream, default to a broker owned by the master
+        broker_path = os.path.join(tempfile.gettempdir(), f'aiochat-{os.getpid()}.sock')
+        config['transport'] = dict(transport, type='unix', path=broker_path)
+    Master(lambda worker: create_app(config, worker), health_status,
+           args.host, args.port, args.workers, broker_path=broker_path).run()
 
 
 if __name__ == '__main__':
-    uvloop.install()
-    web.run_app(app, host='127.0.0.1', port=8000)
+    main()
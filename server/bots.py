@@ -2,12 +2,26 @@ import abc
 import logging
 import asyncio
 from asyncio import queues
-
+from collections import deque
+from contextlib import aclosing
+from contextlib import suppress
+from datetime import datetime
+from time import perf_counter
+
+from commands import COMMANDS
+from commands import CommandError
+from commands import one_of
+from event import DEFAULT_ROOM
+from event import ErrorEvent
 from event import MessageEvent
 from event import IntentEvent
 from dispatch import subscribe
+from db import partitions
 from db.models import IntentDataEntity
 from db.models import MessageEntity
+from history import history_query
+from history import row_after
+from history import row_before
 
 
 LOG = logging.getLogger(__name__)
@@ -31,24 +45,215 @@ class Bot(abc.ABC):
         self._dispatch.unregister(self)
         self._dispatch = None
 
+    async def reply(self, event, message):
+        """
+        Posts `message` as this bot to the room `event` came from.
+        """
+        await self._dispatch.submit(MessageEvent.of(self.client_id, message, event.room_id))
+
 
 class HistoryBot(Bot):
-    def __init__(self, pgpool):
+    """
+    Write-behind persistence for messages. Events are buffered and copied into
+    the message table in batches once `batch_size` rows are pending or every
+    `flush_interval` seconds, whichever comes first. A failed batch goes back to
+    the front of the buffer and is retried on the next interval, the oldest rows
+    are dropped past `max_pending`. Call `close` on shutdown to flush whatever
+    is left.
+    """
+    _COLUMNS = ('client_id', 'value', 'create_time', 'room_id', 'key')
+
+    def __init__(self, pgpool, batch_size=500, flush_interval=0.25, max_pending=10000):
         self.client_id = 'HistoryBot'
         self.pgp = pgpool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._buffer = []
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._flusher = None
+        self._closing = False
+        # set while the last flush failed, the flusher alone retries then
+        self._failing = False
+        self.stats = {
+            'flushes': 0,
+            'flush_failures': 0,
+            'rows': 0,
+            'failed_rows': 0,
+            'last_batch_size': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+        }
 
-
-    @subscribe(kind="MessageEvent")
+    def init(self, dispatcher):
+        super().init(dispatcher)
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_forever())
+
+    async def close(self):
+        """
+        Stops the flusher once its current flush is done and flushes the rest.
+        Close the dispatcher first, events it still delivers are not persisted.
+        """
+        self._closing = True
+        if self._flusher is not None:
+            self._wakeup.set()
+            await self._flusher
+            self._flusher = None
+        await self.flush()
+
+    async def _flush_forever(self):
+        while not self._closing:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            batch, self._buffer = self._buffer, []
+            start = perf_counter()
+            try:
+                async with self.pgp.acquire() as conn:
+                    await MessageEntity.copy_in(conn, batch, columns=self._COLUMNS)
+            except Exception:
+                LOG.exception('failed to flush %d messages, retrying', len(batch))
+                self._requeue(batch)
+                return
+            except BaseException:
+                # cancelled mid copy, keep the rows for the next flush
+                self._requeue(batch)
+                raise
+            self._failing = False
+            elapsed_ms = (perf_counter() - start) * 1000
+            self.stats['flushes'] += 1
+            self.stats['rows'] += len(batch)
+            self.stats['last_batch_size'] = len(batch)
+            self.stats['last_flush_ms'] = elapsed_ms
+            self.stats['max_flush_ms'] = max(self.stats['max_flush_ms'], elapsed_ms)
+
+    def _requeue(self, batch):
+        self._failing = True
+        self.stats['flush_failures'] += 1
+        self._buffer[:0] = batch
+        excess = len(self._buffer) - self.max_pending
+        if excess > 0:
+            del self._buffer[:excess]
+            self.stats['failed_rows'] += excess
+            LOG.warning('dropped %d unflushed messages past max_pending', excess)
+
+    # no timeout, cancelling a backpressure flush would lose the batch
+    @subscribe(kind="MessageEvent", timeout=0)
     async def on_message(self, event: MessageEvent):
-        async with self.pgp.acquire() as conn:
-            await MessageEntity.create(conn, client_id=event.client_id, value=event.message)
+        self._buffer.append((event.client_id, event.message, datetime.fromtimestamp(event.create_time / 1000),
+                             event.room_id, event.key))
+        if len(self._buffer) >= self.max_pending and not self._failing:
+            # the flusher is falling behind, push back on the dispatch worker
+            await self.flush()
+        elif len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
 
     
-    @subscribe(intent="clearHistory")
+    @subscribe(intent="purgeHistory", timeout=60, background=True, args={})
+    async def on_purge(self, event):
+        """
+        Clears every room by dropping the message partitions, no row is deleted.
+        """
+        async with self._flush_lock:
+            self._buffer.clear()
+            async with self.pgp.acquire() as conn:
+                await partitions.clear(conn)
+        await self.reply(event, 'purged')
+
+    # one room's rows share partitions with every other room, they are deleted
+    @subscribe(intent="clearHistory", timeout=60, background=True, args={})
     async def on_start(self, event):
+        room_id = event.room_id
+        async with self._flush_lock:
+            self._buffer = [row for row in self._buffer if row[3] != room_id]
+            async with self.pgp.acquire() as conn:
+                await conn.execute('DELETE FROM message WHERE room_id = $1', room_id)
+        await self.reply(event, 'cleared')
+
+
+class RecentHistoryBot(Bot):
+    """
+    Ring buffer of the last `size` messages, warmed from Postgres at startup and
+    kept current from the dispatcher. `query` answers history pages that fall
+    inside the buffer so reconnecting clients don't hit the message table.
+    """
+    def __init__(self, pgpool, size=1000):
+        self.client_id = 'RecentHistoryBot'
+        self.pgp = pgpool
+        self._rows = deque(maxlen=size)
+        # True while the buffer holds every stored message
+        self._complete = True
+        self.stats = {'hits': 0, 'misses': 0}
+
+    async def warm(self):
+        sql, args = history_query(limit=self._rows.maxlen)
         async with self.pgp.acquire() as conn:
-            await conn.execute('DELETE FROM message WHERE TRUE;')
-        await self._dispatch.submit(MessageEvent.of(self.client_id, 'cleared'))
+            records = await conn.fetch(sql, *args)
+        self._rows.clear()
+        self._rows.extend(dict(r) for r in records)
+        self._complete = len(records) < self._rows.maxlen
+
+    def query(self, before=None, after=None, limit=100, room_id=DEFAULT_ROOM):
+        """
+        Same contract as `history_query`, returns None when the page isn't covered.
+        The buffer holds the newest messages of every room, so a room's rows in it
+        are all of that room's rows since the oldest buffered one.
+        """
+        rows = self._rows
+        if after:
+            covered = self._complete or (rows and not row_after(rows[0], after))
+            matched = [r for r in rows if r['room_id'] == room_id and row_after(r, after)
+                       and (not before or row_before(r, before))][:limit]
+        else:
+            matched = [r for r in rows if r['room_id'] == room_id and (not before or row_before(r, before))]
+            covered = self._complete or len(matched) >= limit
+            matched = matched[-limit:]
+        if not covered:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return matched
+
+    @subscribe(kind="MessageEvent", remote=True)
+    async def on_message(self, event):
+        rows = self._rows
+        row = {
+            # the id is assigned when HistoryBot flushes, the key sorts the same way
+            'id': None,
+            'key': event.key,
+            'create_time': datetime.fromtimestamp(event.create_time / 1000),
+            'value': event.message,
+            'client_id': event.client_id,
+            'room_id': event.room_id,
+        }
+        if len(rows) == rows.maxlen:
+            rows.popleft()
+            self._complete = False
+        # lanes run concurrently, so an event can land slightly behind the tail
+        idx = len(rows)
+        while idx > 0 and (rows[idx - 1]['create_time'], rows[idx - 1]['key']) > (row['create_time'], row['key']):
+            idx -= 1
+        rows.insert(idx, row)
+
+    @subscribe(intent="purgeHistory", remote=True, args={})
+    async def on_purge(self, event):
+        self._rows.clear()
+        self._complete = True
+
+    @subscribe(intent="clearHistory", remote=True, args={})
+    async def on_clear(self, event):
+        room_id = event.room_id
+        rows = [r for r in self._rows if r['room_id'] != room_id]
+        self._rows.clear()
+        self._rows.extend(rows)
 
 
 class TranslatorBot(Bot):
@@ -57,11 +262,19 @@ class TranslatorBot(Bot):
     
     @subscribe(kind="WsMessageEvent")
     async def on_message(self, event):
-        intent = IntentEvent.fromMessage(event)
-        if intent:
-            await self._dispatch.submit(intent)
-        elif len(event.message.strip()) > 0:
-            await self._dispatch.submit(MessageEvent.of(event.client_id, event.message.strip()))
+        message = event.message.strip()
+        if not message:
+            return
+        if message[0] != '.':
+            # plain chat, the common case never touches the command parser
+            await self._dispatch.submit(MessageEvent.of(event.client_id, message, event.room_id))
+            return
+        try:
+            action, args, kwargs = COMMANDS.parse(message)
+        except CommandError as e:
+            await self._dispatch.submit(ErrorEvent.of(event.client_id, str(e)))
+            return
+        await self._dispatch.submit(IntentEvent.of(event.client_id, message, action, args, kwargs, event.room_id))
 
 
 class SystemBot(Bot):
@@ -69,18 +282,16 @@ class SystemBot(Bot):
         self.client_id = 'SystemBot'
         self.app = app
 
-    @subscribe(intent="createBot")
+    @subscribe(intent="createBot", args={'bot': one_of('QuestionBot', 'IntentRecorderBot')})
     async def on_start(self, event):
-        if event.args and event.args[0] == 'QuestionBot':
+        if event.kwargs['bot'] == 'QuestionBot':
             bot = QuestionBot()
             bot.init(self._dispatch)
-            await self._dispatch.submit(MessageEvent.of(self.client_id, "created questions bot"))
-        elif event.args and event.args[0] == 'IntentRecorderBot':
+            await self.reply(event, "created questions bot")
+        else:
             bot = IntentRecorderBot(self.app)
             bot.init(self._dispatch)
-            await self._dispatch.submit(MessageEvent.of(self.client_id, "created intent bot"))
-        else:
-            await self._dispatch.submit(MessageEvent.of(self.client_id, f"unknown start arg: {event.args}"))
+            await self.reply(event, "created intent bot")
 
 
 class EchoBot(Bot):
@@ -91,7 +302,7 @@ class EchoBot(Bot):
     @subscribe(kind='MessageEvent')
     async def on_message(self, event):
         if event.client_id != self.client_id:
-            await self._dispatch.submit(MessageEvent.of(self.client_id, event.message))
+            await self.reply(event, event.message)
 
 
 class IntentRecorderBot(Bot):
@@ -101,40 +312,60 @@ class IntentRecorderBot(Bot):
         self.mode = None
         self.last_message_id = None
     
-    @subscribe(kind='MessageEvent')
+    @subscribe(kind='MessageEvent', background=True)
     async def on_message(self, event):
         if self.mode is not None:
             async with self.pgp.acquire() as conn:
                 await IntentDataEntity.create(conn, name=self.mode, value=event.message)
 
     
-    @subscribe(intent='exit')
+    @subscribe(intent='exit', args={})
     async def on_exit(self, event):
-        await self._dispatch.submit(MessageEvent.of(self.client_id, 'exiting'))
+        await self.reply(event, 'exiting')
         self.teardown()
 
 
-    @subscribe(intent='setIntent')
+    @subscribe(intent='setIntent', args={'name': str})
     async def on_set_intent(self, event):
-        intent_name = event.args[0]
+        intent_name = event.kwargs['name']
         if intent_name == 'NONE':
-            await self._dispatch.submit(MessageEvent.of(self.client_id, 'exiting'))
+            await self.reply(event, 'exiting')
             self.teardown()
         else:
             self.mode = intent_name
-            await self._dispatch.submit(MessageEvent.of(self.client_id, f'using intent "{intent_name}"'))
+            await self.reply(event, f'using intent "{intent_name}"')
 
 
-    @subscribe(intent='listIntents')
+    # rows listed by .listIntents, and rows per chat message
+    _LIST_LIMIT = 200
+    _LIST_CHUNK = 50
+
+    @subscribe(intent='listIntents', args={}, background=True)
     async def on_list_intent(self, event):
         async with self.pgp.acquire() as conn:
-            records = [repr(r) for r in await IntentDataEntity.all()]
-        await self._dispatch.submit(MessageEvent.of(self.client_id, "\n".join(records)))
-
-
-    @subscribe(intent='getState')
+            total = await IntentDataEntity.count(conn)
+            lines = []
+            listed = 0
+            # aclosing ends the cursor's transaction on break, before conn goes back to the pool
+            records = IntentDataEntity.iter(conn, order_by='id', batch_size=self._LIST_CHUNK)
+            async with aclosing(records):
+                async for record in records:
+                    lines.append(repr(record))
+                    listed += 1
+                    if len(lines) == self._LIST_CHUNK:
+                        await self.reply(event, "\n".join(lines))
+                        lines = []
+                    if listed == self._LIST_LIMIT:
+                        break
+        if lines:
+            await self.reply(event, "\n".join(lines))
+        if total > listed:
+            await self.reply(event, f'... and {total - listed} more')
+
+
+    @subscribe(intent='getState', args={})
     async def on_get_state(self, event):
-        await self._dispatch.submit(MessageEvent.of(self.client_id, f'mode is "{self.mode}"'))
+        await self.reply(event, f'mode is "{self.mode}"')
 
 
 
@@ -145,9 +376,9 @@ class QuestionBot(Bot):
         self.client_id = 'question_bot'
         self.question_idx = 0
     
-    @subscribe(intent='ASK')
+    @subscribe(intent='ASK', args={})
     async def ask(self, event):
-        await self._dispatch.submit(MessageEvent.of(self.client_id, QuestionBot._QUESTION_SETS['wwwww'][self.question_idx]))
+        await self.reply(event, QuestionBot._QUESTION_SETS['wwwww'][self.question_idx])
         self.question_idx += 1
         if self.question_idx == len(QuestionBot._QUESTION_SETS['wwwww']):
             self.teardown()
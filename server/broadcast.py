@@ -0,0 +1,214 @@
+import asyncio
+import logging
+from collections import deque
+from contextlib import suppress
+
+from bots import Bot
+from dispatch import subscribe
+from framing import JSON
+from framing import MSGPACK
+from framing import batch
+from framing import encode
+from sessions import VISIBLE
+
+
+LOG = logging.getLogger(__name__)
+
+# slow consumer policies, applied when a connection has `max_pending` frames queued
+DROP = 'drop'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+_POLICIES = (DROP, COALESCE, DISCONNECT)
+
+
+class Connection:
+    """
+    Outbound side of one websocket. Frames are queued without awaiting and written
+    by a dedicated task, so a slow socket only ever delays itself.
+    """
+    def __init__(self, hub, ws, max_pending, policy):
+        self.hub = hub
+        self.ws = ws
+        self.max_pending = max_pending
+        self.policy = policy
+        self.dropped = 0
+        self.sent = 0
+        # set once the socket sent `open`
+        self.client_id = None
+        self.rooms = set()
+        # wire format, negotiated at open
+        self.format = JSON
+        self._pending = deque()
+        self._ready = asyncio.Event()
+        self._closing = False
+        self._closer = None
+        self._writer = asyncio.create_task(self._write_forever())
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def offer(self, frame):
+        if self._closing:
+            return
+        pending = self._pending
+        if len(pending) >= self.max_pending:
+            self.dropped += 1
+            if self.policy == DROP:
+                return
+            elif self.policy == COALESCE:
+                pending.popleft()
+            else:
+                LOG.info('disconnecting slow consumer after %d pending frames', len(pending))
+                self._close_soon()
+                return
+        pending.append(frame)
+        self._ready.set()
+
+    def offer_event(self, event):
+        self.offer(encode(event, self.format))
+
+    async def _write_forever(self):
+        pending = self._pending
+        while True:
+            await self._ready.wait()
+            while pending:
+                if self.policy == COALESCE and len(pending) > 1:
+                    # a consumer that fell behind gets everything queued in one array frame,
+                    # text and binary frames (queued before `open` switched format) don't mix
+                    binary = isinstance(pending[0], bytes)
+                    frames = []
+                    while pending and isinstance(pending[0], bytes) == binary:
+                        frames.append(pending.popleft())
+                    count = len(frames)
+                    frame = batch(frames, MSGPACK if binary else JSON) if count > 1 else frames[0]
+                else:
+                    count = 1
+                    frame = pending.popleft()
+                try:
+                    if isinstance(frame, bytes):
+                        await self.ws.send_bytes(frame)
+                    else:
+                        await self.ws.send_str(frame)
+                except Exception as e:
+                    LOG.info('closing connection after failed send: %s', e)
+                    self._close_soon()
+                    return
+                self.sent += count
+            self._ready.clear()
+
+    def _close_soon(self):
+        self._closing = True
+        # the loop only keeps a weak reference to tasks
+        self._closer = asyncio.create_task(self.close())
+
+    async def close(self):
+        self._closing = True
+        self.hub.disconnect(self)
+        if self._writer is not asyncio.current_task():
+            self._writer.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._writer
+        if not self.ws.closed:
+            await self.ws.close()
+
+
+class BroadcastHub(Bot):
+    """
+    Fans MessageEvents out to the websockets that joined the event's room, and
+    PresenceEvents to every websocket that sent `open`. An event is encoded once
+    per wire format in use and the dispatch handlers only enqueue frames, they
+    never await a socket.
+    """
+    def __init__(self, max_pending=256, policy=DROP):
+        if policy not in _POLICIES:
+            raise ValueError(f'unknown slow consumer policy {policy}, expected one of {_POLICIES}')
+        self.client_id = 'BroadcastHub'
+        self.max_pending = max_pending
+        self.policy = policy
+        self._connections = set()
+        # room_id -> {Connection}
+        self._rooms = {}
+        # totals for connections that already went away
+        self._closed_dropped = 0
+        self._closed_sent = 0
+
+    @property
+    def connection_count(self):
+        return len(self._connections)
+
+    def connect(self, ws):
+        conn = Connection(self, ws, self.max_pending, self.policy)
+        self._connections.add(conn)
+        return conn
+
+    def join(self, conn, room_id):
+        conn.rooms.add(room_id)
+        self._rooms.setdefault(room_id, set()).add(conn)
+
+    def leave(self, conn, room_id):
+        conn.rooms.discard(room_id)
+        members = self._rooms.get(room_id)
+        if members is not None:
+            members.discard(conn)
+            if not members:
+                del self._rooms[room_id]
+
+    def room_size(self, room_id):
+        return len(self._rooms.get(room_id, ()))
+
+    def disconnect(self, conn):
+        for room_id in list(conn.rooms):
+            self.leave(conn, room_id)
+        if conn in self._connections:
+            self._connections.remove(conn)
+            self._closed_dropped += conn.dropped
+            self._closed_sent += conn.sent
+
+    async def close(self):
+        for conn in list(self._connections):
+            await conn.close()
+
+    def stats(self):
+        connections = self._connections
+        return {
+            'connections': len(connections),
+            'rooms': len(self._rooms),
+            'queued': sum(c.depth for c in connections),
+            'max_queued': max((c.depth for c in connections), default=0),
+            'sent': self._closed_sent + sum(c.sent for c in connections),
+            'dropped': self._closed_dropped + sum(c.dropped for c in connections),
+            'per_connection': [
+                {'client_id': c.client_id, 'depth': c.depth, 'dropped': c.dropped, 'sent': c.sent}
+                for c in connections
+            ],
+        }
+
+    def slowest(self, n=10):
+        """
+        The `n` open connections that dropped the most frames, then by backlog.
+        """
+        stats = self.stats()['per_connection']
+        return sorted(stats, key=lambda c: (c['dropped'], c['depth']), reverse=True)[:n]
+
+    @subscribe(kind="MessageEvent", remote=True)
+    async def on_message(self, event):
+        members = self._rooms.get(event.room_id)
+        if members:
+            self._fan_out(event, members)
+
+    @subscribe(kind="PresenceEvent", remote=True)
+    async def on_presence(self, event):
+        # joined/left only tell other processes where a client's sessions are
+        if event.status in VISIBLE:
+            # a socket that hasn't sent `open` has no wire format yet
+            self._fan_out(event, [c for c in self._connections if c.client_id is not None])
+
+    def _fan_out(self, event, connections):
+        # format -> encoded frame
+        frames = {}
+        for conn in connections:
+            frame = frames.get(conn.format)
+            if frame is None:
+                frame = frames[conn.format] = encode(event, conn.format)
+            conn.offer(frame)
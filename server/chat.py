@@ -16,28 +16,172 @@ from asyncio import gather
 import uvloop
 
 from bots import Bot
-from dispatch import subscribe
+from dispatch import DispatchRejected
+from event import DEFAULT_ROOM
+from event import ErrorEvent
 from event import MessageEvent
 from event import WsMessageEvent
+from framing import JSON
+from framing import msgpack
+from framing import negotiate
+from helpers import dumps
 from helpers import to_dict
+from history import HISTORY_DEFAULT_LIMIT
+from history import HISTORY_MAX_LIMIT
+from history import format_cursor
+from history import history_query
+from history import parse_cursor
+from search import SEARCH_DEFAULT_LIMIT
+from search import SEARCH_MAX_LIMIT
+from search import format_search_cursor
+from search import parse_search_cursor
+from search import search_query
 
 
 LOG = logging.getLogger(__name__)
 
+MAX_ROOM_LENGTH = 64
+# rooms one socket may be in, each is an entry in the hub's room index
+MAX_ROOMS = 32
+
+
+
+def valid_room(room_id):
+    return isinstance(room_id, str) and 0 < len(room_id) <= MAX_ROOM_LENGTH
+
+
+def _history_params(request, stream):
+    query = request.query
+    limit = query.get('limit')
+    if limit is None:
+        limit = None if stream else HISTORY_DEFAULT_LIMIT
+    else:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise web.HTTPBadRequest(text=f'invalid limit: {limit}')
+        if limit < 1:
+            raise web.HTTPBadRequest(text=f'invalid limit: {limit}')
+        if not stream:
+            limit = min(limit, HISTORY_MAX_LIMIT)
+    try:
+        before = parse_cursor(query['before']) if 'before' in query else None
+        after = parse_cursor(query['after']) if 'after' in query else None
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    room_id = query.get('room', DEFAULT_ROOM)
+    if not valid_room(room_id):
+        raise web.HTTPBadRequest(text=f'invalid room: {room_id}')
+    return before, after, limit, room_id
 
 
 async def get_message_history(request):
-    pgpool = request.app['pgpool']
+    """
+    GET /api/chat/history?room=&limit=&before=&after=&format=json|ndjson
+
+    json responses are capped at HISTORY_MAX_LIMIT rows and carry X-Before-Cursor /
+    X-After-Cursor headers for the next page, and are served from the recent history
+    buffer when the page falls inside it. ndjson streams every matching row through
+    a server side cursor unless a limit is given.
+    """
+    stream = request.query.get('format') == 'ndjson'
+    before, after, limit, room_id = _history_params(request, stream)
+    pgpool = request.app['pgpool_ro']
+    if stream:
+        sql, args = history_query(before, after, limit, room_id)
+        return await _stream_message_history(request, pgpool, sql, args)
+
+    recent = request.app.get('recent_history')
+    records = recent.query(before, after, limit, room_id) if recent else None
+    if records is None:
+        sql, args = history_query(before, after, limit, room_id)
+        async with pgpool.acquire() as conn:
+            records = await conn.fetch(sql, *args)
+    headers = {}
+    if records:
+        headers['X-Before-Cursor'] = format_cursor(records[0]['create_time'], records[0]['key'])
+        headers['X-After-Cursor'] = format_cursor(records[-1]['create_time'], records[-1]['key'])
+    return web.json_response(data=[to_dict(r) for r in records], headers=headers, dumps=dumps)
+
+
+async def search_messages(request):
+    """
+    GET /api/chat/search?q=&room=&client_id=&limit=&after=
+
+    Ranked full-text search within a room, optionally only one client's messages.
+    Pages are capped at SEARCH_MAX_LIMIT hits, X-Next-Cursor is passed as `after`
+    to get the next one.
+    """
+    query = request.query
+    text = query.get('q', '').strip()
+    if not text:
+        raise web.HTTPBadRequest(text='missing search text q')
+    room_id = query.get('room', DEFAULT_ROOM)
+    if not valid_room(room_id):
+        raise web.HTTPBadRequest(text=f'invalid room: {room_id}')
+    try:
+        limit = min(int(query.get('limit', SEARCH_DEFAULT_LIMIT)), SEARCH_MAX_LIMIT)
+        after = parse_search_cursor(query['after']) if 'after' in query else None
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    if limit < 1:
+        raise web.HTTPBadRequest(text=f'invalid limit: {limit}')
+
+    sql, args = search_query(text, room_id, query.get('client_id'), after, limit)
+    async with request.app['pgpool_ro'].acquire() as conn:
+        records = await conn.fetch(sql, *args)
+    headers = {}
+    if len(records) == limit:
+        headers['X-Next-Cursor'] = format_search_cursor(records[-1]['rank'], records[-1]['id'])
+    return web.json_response(data=[to_dict(r) for r in records], headers=headers, dumps=dumps)
+
+
+async def get_presence(request):
+    """
+    GET /api/chat/presence[?client_id=]
+
+    Clients connected to this process and how many sessions each has open plus
+    the ones only connected to other workers, or whether one client is online
+    on any worker and its sessions here.
+    """
+    sessions = request.app['sessions']
+    client_id = request.query.get('client_id')
+    if client_id is not None:
+        tabs = len(sessions.connections(client_id))
+        return web.json_response(data={'client_id': client_id, 'online': sessions.is_online(client_id),
+                                       'sessions': tabs}, dumps=dumps)
+    return web.json_response(data={'clients': sessions.online(), 'elsewhere': sessions.elsewhere()}, dumps=dumps)
+
+
+async def _stream_message_history(request, pgpool, sql, args, batch_size=200):
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
     async with pgpool.acquire() as conn:
-        records = await conn.fetch('SELECT create_time, value, client_id FROM message')
-    return web.json_response(data=[to_dict(r) for r in records])
+        async with conn.transaction():
+            lines = []
+            async for record in conn.cursor(sql, *args, prefetch=batch_size):
+                lines.append(dumps(to_dict(record)).encode())
+                if len(lines) == batch_size:
+                    lines.append(b'')
+                    await response.write(b'\n'.join(lines))
+                    lines = []
+            if lines:
+                lines.append(b'')
+                await response.write(b'\n'.join(lines))
+    await response.write_eof()
+    return response
 
 
 
 class WsBot(Bot):
-    def __init__(self, ws):
+    """
+    Inbound side of a websocket, outbound frames go through its hub `Connection`.
+    """
+    def __init__(self, ws, conn, sessions):
         self.client_id = None
         self.ws = ws
+        self.conn = conn
+        self.sessions = sessions
     
     async def run_until_close(self):
         while not self.ws.closed:
@@ -53,15 +197,38 @@ class WsBot(Bot):
                 break
             
             if msg:
-                if msg.type == WSMsgType.TEXT:
+                if msg.type in (WSMsgType.TEXT, WSMsgType.BINARY):
                     # await route_message(ws, msg, app=request.app)
                     # TODO: put into an Event and continue looping
                     try:
-                        payload = json.loads(msg.data)
+                        if msg.type == WSMsgType.TEXT:
+                            payload = json.loads(msg.data)
+                        else:
+                            payload = msgpack.unpackb(msg.data)
                         if payload['type'] == 'open' and self.client_id is None:
-                            self.client_id = payload['clientId']
-                        elif payload['type'] == 'create_message' and self.client_id is not None:
-                            await self._dispatch.submit(WsMessageEvent.of(self.client_id, payload['text']))
+                            self.client_id = self.conn.client_id = payload['clientId']
+                            self.conn.format = negotiate(payload.get('format', JSON))
+                            await self.sessions.join(self.client_id, self.conn)
+                            rooms = payload.get('rooms') or [DEFAULT_ROOM]
+                            if not isinstance(rooms, list) or not all(isinstance(r, str) for r in rooms):
+                                self.error('rooms must be a list of room names')
+                            elif len(rooms) > MAX_ROOMS:
+                                self.error(f'at most {MAX_ROOMS} rooms per connection')
+                            else:
+                                for room_id in rooms:
+                                    self.join(room_id)
+                        elif self.client_id is None:
+                            pass
+                        elif payload['type'] == 'create_message':
+                            room_id = payload.get('room', DEFAULT_ROOM)
+                            if room_id in self.conn.rooms:
+                                await self.submit(WsMessageEvent.of(self.client_id, payload['text'], room_id))
+                            else:
+                                self.error(f'not a member of room {room_id}')
+                        elif payload['type'] == 'join':
+                            self.join(payload['room'])
+                        elif payload['type'] == 'leave':
+                            self.conn.hub.leave(self.conn, payload['room'])
                     except Exception as e:
                         print(f'error processing message: {msg}')
                         print(e)
@@ -75,24 +242,45 @@ class WsBot(Bot):
                 else:
                     print(f'unknown message type {msg.type}')
 
-    
-    @subscribe(kind="MessageEvent")
-    async def on_message(self, event):
-        # echo
-        await self.ws.send_json(event.as_dict())
+
+    def join(self, room_id):
+        if not valid_room(room_id):
+            self.error(f'invalid room {room_id!r}')
+        elif room_id not in self.conn.rooms and len(self.conn.rooms) >= MAX_ROOMS:
+            self.error(f'at most {MAX_ROOMS} rooms per connection')
+        else:
+            self.conn.hub.join(self.conn, room_id)
+
+    def error(self, message):
+        self.conn.offer_event(ErrorEvent.of(self.client_id, message))
+
+    async def submit(self, event):
+        try:
+            await self._dispatch.submit(event)
+        except DispatchRejected:
+            self.error('server busy, message was not delivered')
 
 
 async def chat_ws(request):
     print('got ws request')
-    ws = web.WebSocketResponse()
+    ws = web.WebSocketResponse(compress=request.app['config'].get('websocket', {}).get('compress', True))
     await ws.prepare(request)
-    bot = WsBot(ws)
+    conn = request.app['hub'].connect(ws)
+    sessions = request.app['sessions']
+    bot = WsBot(ws, conn, sessions)
     bot.init(request.app['dispatcher'])
-    await bot.run_until_close()
-    bot.teardown()
+    try:
+        await bot.run_until_close()
+    finally:
+        bot.teardown()
+        if bot.client_id is not None:
+            await sessions.leave(bot.client_id, conn)
+        await conn.close()
     return ws
     
 
 def init_app(app):
     app.router.add_get('/api/chat/ws', chat_ws)
-    app.router.add_get('/api/chat/history', get_message_history)
\ No newline at end of file
+    app.router.add_get('/api/chat/history', get_message_history)
+    app.router.add_get('/api/chat/presence', get_presence)
+    app.router.add_get('/api/chat/search', search_messages)
\ No newline at end of file
@@ -0,0 +1,125 @@
+"""
+Chat commands, `.action arg key=value`. Each `subscribe(intent=...)` declares its
+command here when the bot class is defined, so every intent is known before any
+message is parsed and unknown ones can be turned away up front.
+"""
+
+
+class CommandError(ValueError):
+    pass
+
+
+def one_of(*choices):
+    """
+    Argument converter that only accepts `choices`.
+    """
+    allowed = frozenset(choices)
+
+    def convert(value):
+        if value not in allowed:
+            raise ValueError(f'expected one of {", ".join(choices)}')
+        return value
+    convert.choices = choices
+    return convert
+
+
+class Command:
+    __slots__ = ('name', 'schema', 'names')
+
+    def __init__(self, name, schema=None):
+        """
+        `schema` maps argument names to converters in positional order, None
+        passes arguments through as strings without checking them.
+        """
+        self.name = name
+        self.schema = None if schema is None else tuple(schema.items())
+        self.names = None if schema is None else frozenset(schema)
+
+    def bind(self, tokens):
+        """
+        Splits `tokens` into positional and `key=value` arguments and applies the
+        schema. Typed commands get every argument in both: `args` in schema order
+        and `kwargs` by name.
+        """
+        schema = self.schema
+        if not tokens and not schema:
+            return [], {}
+        args = []
+        kwargs = {}
+        for token in tokens:
+            if '=' in token:
+                key, _, value = token.partition('=')
+                kwargs[key] = value
+            else:
+                args.append(token)
+        if schema is None:
+            return args, kwargs
+
+        if len(args) > len(schema):
+            raise CommandError(f'.{self.name} takes {len(schema)} argument(s), got {len(args)}')
+        for key in kwargs:
+            if key not in self.names:
+                raise CommandError(f'.{self.name} has no argument {key}')
+        bound = []
+        for idx, (name, convert) in enumerate(schema):
+            if idx < len(args):
+                if name in kwargs:
+                    raise CommandError(f'.{self.name} got {name} twice')
+                raw = args[idx]
+            elif name in kwargs:
+                raw = kwargs[name]
+            else:
+                raise CommandError(f'.{self.name} is missing {name}')
+            try:
+                value = convert(raw)
+            except (TypeError, ValueError) as e:
+                raise CommandError(f'.{self.name} {name}={raw}: {e}') from None
+            bound.append(value)
+            kwargs[name] = value
+        return bound, kwargs
+
+    def usage(self):
+        if self.schema is None:
+            return f'.{self.name} ...'
+        return ' '.join([f'.{self.name}'] + [f'<{name}>' for name, _ in self.schema])
+
+
+class CommandRegistry:
+    def __init__(self):
+        # action -> Command
+        self._commands = {}
+
+    def __contains__(self, name):
+        return name in self._commands
+
+    def __iter__(self):
+        return iter(self._commands.values())
+
+    def declare(self, name, schema=None):
+        """
+        Several bots may handle the same intent, they have to agree on its schema.
+        An untyped declaration defers to a typed one.
+        """
+        existing = self._commands.get(name)
+        command = Command(name, schema)
+        if existing is None or existing.schema is None:
+            self._commands[name] = command
+        elif command.schema is not None and command.schema != existing.schema:
+            raise ValueError(f'conflicting argument schemas for .{name}')
+        return self._commands[name]
+
+    def parse(self, text):
+        """
+        Parses a stripped message starting with '.' into (action, args, kwargs),
+        raises `CommandError` for unknown commands and bad arguments.
+        """
+        tokens = text.split()
+        name = tokens[0][1:]
+        command = self._commands.get(name)
+        if command is None:
+            raise CommandError(f'unknown command .{name}')
+        args, kwargs = command.bind(tokens[1:])
+        return name, args, kwargs
+
+
+COMMANDS = CommandRegistry()
@@ -1,5 +1,10 @@
 import logging
 from dataclasses import dataclass
+from datetime import date
+from datetime import timedelta
+
+from db.partitions import PARTITION_DAYS_AHEAD
+from db.partitions import create_partitions
 
 
 LOG = logging.Logger(__name__)
@@ -66,6 +71,90 @@ async def init_tables(conn):
     ''')
 
 
+async def add_rooms(conn):
+    await conn.execute('''
+        ALTER TABLE message ADD COLUMN room_id VARCHAR NOT NULL DEFAULT 'lobby';
+        CREATE INDEX message_room_create_time_idx ON message(room_id, create_time, id);
+    ''')
+
+
+async def add_search(conn):
+    await conn.execute('''
+        ALTER TABLE message ADD COLUMN search tsvector
+            GENERATED ALWAYS AS (to_tsvector('english', value)) STORED;
+        CREATE INDEX message_search_idx ON message USING GIN (search);
+    ''')
+
+
+async def partition_messages(conn):
+    """
+    Rebuilds message as a table range partitioned by day on create_time. The id
+    sequence is kept, the primary key has to include the partition key.
+    """
+    await conn.execute('''
+        ALTER TABLE message RENAME TO message_unpartitioned;
+        ALTER INDEX message_pkey RENAME TO message_unpartitioned_pkey;
+        ALTER INDEX message_create_time_idx RENAME TO message_unpartitioned_create_time_idx;
+        ALTER INDEX message_room_create_time_idx RENAME TO message_unpartitioned_room_create_time_idx;
+        ALTER INDEX message_search_idx RENAME TO message_unpartitioned_search_idx;
+        ALTER SEQUENCE message_id_seq OWNED BY NONE;
+
+        CREATE TABLE message (
+            id              INTEGER NOT NULL DEFAULT nextval('message_id_seq'),
+            create_time     TIMESTAMP NOT NULL DEFAULT now(),
+            client_id       VARCHAR NOT NULL,
+            value           VARCHAR NOT NULL,
+            room_id         VARCHAR NOT NULL DEFAULT 'lobby',
+            search          tsvector GENERATED ALWAYS AS (to_tsvector('english', value)) STORED,
+            PRIMARY KEY (id, create_time)
+        ) PARTITION BY RANGE (create_time);
+        CREATE INDEX message_create_time_idx ON message(create_time);
+        CREATE INDEX message_room_create_time_idx ON message(room_id, create_time, id);
+        CREATE INDEX message_search_idx ON message USING GIN (search);
+    ''')
+    today = date.today()
+    oldest = await conn.fetchval('SELECT min(create_time) FROM message_unpartitioned')
+    # rows stamped in the future by a skewed clock need a home too
+    newest = await conn.fetchval('SELECT max(create_time) FROM message_unpartitioned')
+    first_day = oldest.date() if oldest else today
+    last_day = max(newest.date() if newest else today, today + timedelta(days=PARTITION_DAYS_AHEAD))
+    await create_partitions(conn, min(first_day, today), last_day)
+    await conn.execute('''
+        INSERT INTO message (id, create_time, client_id, value, room_id)
+        SELECT id, create_time, client_id, value, room_id FROM message_unpartitioned;
+        DROP TABLE message_unpartitioned;
+        ALTER SEQUENCE message_id_seq OWNED BY message.id;
+    ''')
+
+
+async def add_message_key(conn):
+    """
+    Stores the event key, the tiebreaker history pages sort on after create_time.
+    Older rows get a key with node 00000000 and the id as sequence, which keeps
+    their order.
+    """
+    await conn.execute('''
+        ALTER TABLE message ADD COLUMN key VARCHAR;
+        UPDATE message SET key = lpad(to_hex((extract(epoch FROM create_time) * 1000)::bigint), 12, '0')
+                                 || '00000000' || lpad(to_hex(id & 16777215), 6, '0');
+        ALTER TABLE message ALTER COLUMN key SET NOT NULL;
+        CREATE INDEX message_room_create_time_key_idx ON message(room_id, create_time, key);
+        DROP INDEX message_room_create_time_idx;
+    ''')
+
+
+async def add_default_partition(conn):
+    """
+    Catches rows outside the daily partitions, see db.partitions.
+    """
+    await conn.execute('CREATE TABLE message_default PARTITION OF message DEFAULT')
+
+
 _MIGRATIONS = [
-    (0, 'init', init_tables)
+    (0, 'init', init_tables),
+    (1, 'rooms', add_rooms),
+    (2, 'search', add_search),
+    (3, 'partition_message', partition_messages),
+    (4, 'message_key', add_message_key),
+    (5, 'message_default_partition', add_default_partition),
 ]
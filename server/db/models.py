@@ -4,9 +4,11 @@ from db.orm import Table
 
 class MessageEntity(Table):
     id              = Column(primary_key=True)
+    key             = Column
     create_time     = Column
     client_id       = Column
     value           = Column
+    room_id         = Column
 
 
 class IntentDataEntity(Table):
@@ -18,11 +18,33 @@ with pg.transaction():
     await rec.create(pg)
 # rec now has the id, create_time populated by the create statement
 
+# entities are slotted, a slot per column
+
 ## updates
 with pg.transaction():
     await rec.update(pg, data='bar')
 # rec now has data = bar
 
+## bulk writes
+await Entity.create_many(pg, [{'data': 'a'}, {'data': 'b'}])  # executemany, returns None
+recs = await Entity.create_many(pg, [{'data': 'a'}], returning=True)  # hydrated entities
+await Entity.upsert_many(pg, [{'id': 1, 'data': 'c'}])  # ON CONFLICT (id) DO UPDATE
+await Entity.copy_in(pg, [('d',), ('e',)], columns=('data',))  # COPY, fastest
+
+## reads
+async for rec in Entity.iter(pg, where={'data': 'a'}, order_by='-created'):  # server side cursor
+    ...
+n = await Entity.count(pg, where='create_time > $1', args=(yesterday,))
+recs, cursor = await Entity.page(pg, limit=100, order_by=('created', 'id'))
+recs, cursor = await Entity.page(pg, limit=100, order_by=('created', 'id'), after=cursor)  # None when done
+
+## prepared statements
+class PreparedEntity(Table):
+    _table   = 'entity'  # defaults to the snake cased class name
+    _prepare = True      # hold conn.prepare()d statements per direct connection, pooled
+                         # connections use asyncpg's statement cache (statement_cache_size)
+    ...
+
 ## query
 records = await Entity.find_by_create_time_gt(pg, create_time=datetime.now())
 
@@ -32,6 +54,7 @@ records = await rec.find_by_create_time_gt(pg)
 """
 
 import asyncpg
+import asyncpg.pool
 import logging
 
 LOG = logging.getLogger(__name__)
@@ -48,67 +71,336 @@ class Column:
         self.attr = name if not 'attr' in kwargs else kwargs['attr']
 
 
+# bounds the per-table statement cache, multi-row inserts vary with the row count
+_STMT_CACHE_SIZE = 256
+
+
 class TableMeta:
-    def __init__(self, name, cols):
+    def __init__(self, name, cols, prepare=False):
         self.name = name
         self.cols = cols
         self.col_map = {c.attr: c for c in self.cols}
         self.name_attr = {c.name: c.attr for c in self.cols}
         pkl = list(filter(lambda col: col.primary_key, cols))
         self.pk = pkl[0] if pkl else None
+        self.prepare = prepare
+        self.select_all_sql = f'SELECT * FROM {name}'
+        # (op, *signature) -> statement text
+        self._stmts = {}
+        # connection -> {statement text: PreparedStatement}, dropped when the connection closes
+        self._prepared = {}
+
+    def statement(self, key, build, *args):
+        """
+        Returns the statement cached under `key`, calling `build(*args)` on a miss.
+        """
+        stmt = self._stmts.get(key)
+        if stmt is None:
+            if len(self._stmts) >= _STMT_CACHE_SIZE:
+                self._stmts.clear()
+            stmt = self._stmts[key] = build(*args)
+            LOG.debug('statement: %s', stmt)
+        return stmt
+
+    async def run(self, pg, method, stmt, *args, timeout=None):
+        """
+        Runs `stmt` with the connection method of the same name (fetch, fetchrow,
+        executemany), through a prepared statement when the table opted in.
+        """
+        if self.prepare and not isinstance(pg, asyncpg.pool.PoolConnectionProxy):
+            prepared = await self._prepared_statement(pg, stmt)
+            return await getattr(prepared, method)(*args, timeout=timeout)
+        return await getattr(pg, method)(stmt, *args, timeout=timeout)
+
+    async def _prepared_statement(self, conn, stmt):
+        # statements prepared through a pool proxy stop working once it is released,
+        # pooled connections go through asyncpg's own per connection statement cache
+        stmts = self._prepared.get(conn)
+        if stmts is None:
+            stmts = self._prepared[conn] = {}
+            # the statements reference the connection, a weak key would never go away
+            conn.add_termination_listener(self._forget)
+        prepared = stmts.get(stmt)
+        if prepared is None:
+            prepared = stmts[stmt] = await conn.prepare(stmt)
+        return prepared
+
+    def _forget(self, conn):
+        self._prepared.pop(conn, None)
 
 
 def table_init(table_meta):
     def init(self, *args, **kwargs):
-        unused_attr = list(table_meta.name_attr.values())
-        for k, v in kwargs.items():
-            attr = table_meta.name_attr.get(k)
-            if attr:
-                setattr(self, attr, v)
-                unused_attr.remove(attr)
-        for k in unused_attr:
-            setattr(self, k, None)
+        """
+        Keyword arguments are keyed by column name, like a fetched record.
+        """
+        for name, attr in table_meta.name_attr.items():
+            setattr(self, attr, kwargs.get(name))
     return init
 
 
+def table_loaders(table_meta):
+    """
+    (from_record, load) compiled for the table's columns: one attribute store
+    per column, no per row loop or setattr. Columns missing from the record
+    are None.
+    """
+    assign = ''.join(f'    self.{c.attr} = get({c.name!r})\n' for c in table_meta.cols)
+    src = (f'def from_record(clz, record, new=object.__new__):\n'
+           f'    self = new(clz)\n    get = record.get\n{assign}    return self\n'
+           f'def load(self, record):\n    get = record.get\n{assign}')
+    ns = {}
+    exec(compile(src, f'<orm {table_meta.name}>', 'exec'), ns)
+    return ns['from_record'], ns['load']
+
+
+def _create_sql(table_meta, given_cols):
+    col_sql = ",".join(table_meta.col_map[k].name for k in given_cols)
+    return f'INSERT INTO {table_meta.name} ({col_sql}) VALUES {_values_sql(len(given_cols), 1)} RETURNING *'
+
+
+def _update_sql(table_meta, given_cols):
+    set_sql = ", ".join(f'{table_meta.col_map[k].name}=${i + 1}' for i, k in enumerate(given_cols))
+    return f'UPDATE {table_meta.name} SET {set_sql} WHERE {table_meta.pk.name}=${len(given_cols) + 1} RETURNING *'
+
+
+def _insert_sql(table_meta, given_cols, n_rows, suffix, returning):
+    col_sql = ",".join(table_meta.col_map[k].name for k in given_cols)
+    returning_sql = ' RETURNING *' if returning else ''
+    return f'INSERT INTO {table_meta.name} ({col_sql}) VALUES {_values_sql(len(given_cols), n_rows)}{suffix}{returning_sql}'
+
+
+def _upsert_suffix(table_meta, conflict, update):
+    conflict_sql = ",".join(table_meta.col_map[k].name for k in conflict)
+    if not update:
+        return f' ON CONFLICT ({conflict_sql}) DO NOTHING'
+    names = [table_meta.col_map[k].name for k in update]
+    return f' ON CONFLICT ({conflict_sql}) DO UPDATE SET {", ".join(f"{n}=EXCLUDED.{n}" for n in names)}'
+
+
 def table_create(table_meta):
     async def create(cls, pg: asyncpg.Connection, timeout=None, **kwargs):
-        given_cols = [given_key for given_key in kwargs.keys() if given_key in table_meta.col_map]
-        stmt = f'INSERT INTO {table_meta.name} ({",".join(given_cols)}) VALUES ($1{"".join([f",${i}" for i in range(2, len(given_cols) + 1)])}) RETURNING *'
-        LOG.debug('statement: %s', stmt)
-        res = await pg.fetchrow(stmt, *[kwargs[k] for k in given_cols], timeout=timeout)
-        return cls(**res)
+        given_cols = tuple(given_key for given_key in kwargs.keys() if given_key in table_meta.col_map)
+        stmt = table_meta.statement(('create', given_cols), _create_sql, table_meta, given_cols)
+        res = await table_meta.run(pg, 'fetchrow', stmt, *[kwargs[k] for k in given_cols], timeout=timeout)
+        return cls._from_record(res)
     return create
 
 
+# postgres caps a statement at 32767 bind parameters
+_MAX_PARAMS = 32767
+
+
+def _bulk_cols(table_meta, rows):
+    given_cols = [k for k in rows[0].keys() if k in table_meta.col_map]
+    for row in rows:
+        if row.keys() != rows[0].keys():
+            raise ValueError(f'bulk rows for {table_meta.name} must share the same keys')
+    return given_cols
+
+
+def _values_sql(n_cols, n_rows):
+    return ",".join(
+        "(" + ",".join(f"${r * n_cols + c + 1}" for c in range(n_cols)) + ")"
+        for r in range(n_rows))
+
+
+async def _insert_rows(clz, table_meta, pg, rows, suffix, returning, timeout):
+    given_cols = tuple(_bulk_cols(table_meta, rows))
+    if not returning:
+        stmt = table_meta.statement(('insert', given_cols, 1, suffix, False), _insert_sql, table_meta, given_cols, 1, suffix, False)
+        await table_meta.run(pg, 'executemany', stmt, [[row[k] for k in given_cols] for row in rows], timeout=timeout)
+        return None
+
+    rv = []
+    chunk = max(1, _MAX_PARAMS // max(1, len(given_cols)))
+    for start in range(0, len(rows), chunk):
+        part = rows[start:start + chunk]
+        key = ('insert', given_cols, len(part), suffix, True)
+        stmt = table_meta.statement(key, _insert_sql, table_meta, given_cols, len(part), suffix, True)
+        args = [row[k] for row in part for k in given_cols]
+        rv.extend(map(clz._from_record, await table_meta.run(pg, 'fetch', stmt, *args, timeout=timeout)))
+    return rv
+
+
+def table_create_many(table_meta):
+    async def create_many(cls, pg: asyncpg.Connection, rows, returning=False, timeout=None):
+        if not rows:
+            return [] if returning else None
+        return await _insert_rows(cls, table_meta, pg, rows, '', returning, timeout)
+    return create_many
+
+
+def table_upsert_many(table_meta):
+    async def upsert_many(cls, pg: asyncpg.Connection, rows, conflict=None, update=None, returning=False, timeout=None):
+        """
+        `conflict` are the attrs of the unique constraint (defaults to the primary key),
+        `update` the attrs overwritten on conflict (defaults to every other given attr).
+        """
+        if not rows:
+            return [] if returning else None
+        conflict = tuple(conflict or (table_meta.pk.attr,))
+        if update is None:
+            update = [k for k in _bulk_cols(table_meta, rows) if k not in conflict]
+        update = tuple(update)
+        suffix = table_meta.statement(('upsert', conflict, update), _upsert_suffix, table_meta, conflict, update)
+        return await _insert_rows(cls, table_meta, pg, rows, suffix, returning, timeout)
+    return upsert_many
+
+
+def table_copy_in(table_meta):
+    async def copy_in(cls, pg: asyncpg.Connection, rows, columns=None, timeout=None):
+        """
+        COPYs `rows` into the table. Rows are tuples ordered like `columns` (attr names),
+        by default every column but the primary key in declaration order so the key is
+        generated, or dicts keyed by attr, in which case `columns` defaults to the first
+        row's keys.
+        """
+        if not rows:
+            return None
+        is_dict = isinstance(rows[0], dict)
+        if columns is None:
+            columns = _bulk_cols(table_meta, rows) if is_dict else tuple(
+                attr for attr, col in table_meta.col_map.items() if not col.primary_key)
+            if not is_dict and len(rows[0]) != len(columns):
+                raise ValueError(f'{table_meta.name} rows have {len(columns)} columns, '
+                                 f'got {len(rows[0])}, pass `columns`')
+        if is_dict:
+            rows = [tuple(row[k] for k in columns) for row in rows]
+        names = [table_meta.col_map[k].name for k in columns]
+        return await pg.copy_records_to_table(table_meta.name, records=rows, columns=names, timeout=timeout)
+    return copy_in
+
+
 def table_update(table_meta):
     async def update(self, pg: asyncpg.Connection, timeout=None, **kwargs):
-        set_sql = []
-        var_list = []
-        for k,v in kwargs.items():
-            if k in table_meta.col_map:
-                col = table_meta.col_map.get(k)
-                set_sql.append(f'{col.name}=${len(var_list) + 1}')
-                var_list.append(v)
-
-        stmt = f'UPDATE {table_meta.name} SET {", ".join(set_sql)} WHERE {table_meta.pk.name}={getattr(self, table_meta.pk.attr)} RETURNING *'
-        LOG.debug('statement: %s', stmt)
-        res = await pg.fetchrow(stmt, *var_list, timeout=timeout)
-        self.__init__(**res)  # why not?
+        given_cols = tuple(k for k in kwargs.keys() if k in table_meta.col_map)
+        stmt = table_meta.statement(('update', given_cols), _update_sql, table_meta, given_cols)
+        var_list = [kwargs[k] for k in given_cols]
+        var_list.append(getattr(self, table_meta.pk.attr))
+        res = await table_meta.run(pg, 'fetchrow', stmt, *var_list, timeout=timeout)
+        table_meta.load(self, res)
         return self
     return update
 
 
+def _where_sql(table_meta, where, args):
+    """
+    `where` is a dict of attr -> value compared for equality, or raw SQL using
+    $n placeholders for `args`. Returns (sql, args, cache key).
+    """
+    if not where:
+        return '', list(args), None
+    if isinstance(where, str):
+        return f' WHERE {where}', list(args), where
+    attrs = tuple(where)
+    args = list(args)
+    conds = []
+    for attr in attrs:
+        args.append(where[attr])
+        conds.append(f'{table_meta.col_map[attr].name}=${len(args)}')
+    return f' WHERE {" AND ".join(conds)}', args, attrs
+
+
+def _order_cols(table_meta, order_by):
+    """
+    ((attr, descending), ...) from an attr or tuple of attrs, '-attr' sorts descending.
+    """
+    if order_by is None:
+        return ()
+    if isinstance(order_by, str):
+        order_by = (order_by,)
+    return tuple((o[1:], True) if o.startswith('-') else (o, False) for o in order_by)
+
+
+def _order_sql(table_meta, order):
+    if not order:
+        return ''
+    return ' ORDER BY ' + ', '.join(
+        f'{table_meta.col_map[attr].name}{" DESC" if desc else ""}' for attr, desc in order)
+
+
+def _select_sql(table_meta, where_sql, order, keyset, limit):
+    """
+    `keyset` is the position of the first keyset placeholder, `limit` of the limit one.
+    """
+    sql = f'SELECT * FROM {table_meta.name}{where_sql}'
+    if keyset:
+        names = ', '.join(table_meta.col_map[attr].name for attr, _ in order)
+        params = ', '.join(f'${keyset + i}' for i in range(len(order)))
+        op = '<' if order[0][1] else '>'
+        sql += f' {"AND" if where_sql else "WHERE"} ({names}) {op} ({params})'
+    sql += _order_sql(table_meta, order)
+    if limit:
+        sql += f' LIMIT ${limit}'
+    return sql
+
+
+def table_iter(table_meta):
+    async def t_iter(clz, pg: asyncpg.Connection, where=None, args=(), order_by=None, batch_size=500):
+        """
+        Streams matching rows through a server side cursor, `batch_size` rows are
+        fetched at a time so memory stays flat however large the table. A cursor
+        needs a transaction, one is opened unless `pg` is already in one.
+        """
+        order = _order_cols(table_meta, order_by)
+        where_sql, args, where_key = _where_sql(table_meta, where, args)
+        stmt = table_meta.statement(('iter', where_key, order), _select_sql, table_meta, where_sql, order, 0, 0)
+        from_record = clz._from_record
+        if pg.is_in_transaction():
+            async for r in pg.cursor(stmt, *args, prefetch=batch_size):
+                yield from_record(r)
+            return
+        async with pg.transaction():
+            async for r in pg.cursor(stmt, *args, prefetch=batch_size):
+                yield from_record(r)
+    return t_iter
+
+
+def table_count(table_meta):
+    async def count(clz, pg: asyncpg.Connection, where=None, args=(), timeout=None):
+        where_sql, args, where_key = _where_sql(table_meta, where, args)
+        stmt = table_meta.statement(('count', where_key), lambda: f'SELECT count(*) FROM {table_meta.name}{where_sql}')
+        return await table_meta.run(pg, 'fetchval', stmt, *args, timeout=timeout)
+    return count
+
+
+def table_page(table_meta):
+    async def page(clz, pg: asyncpg.Connection, limit, after=None, order_by=None, where=None, args=(), timeout=None):
+        """
+        One keyset page of at most `limit` rows ordered by `order_by` (defaults to
+        the primary key), which has to be unique and sort every attr the same way.
+        Returns (rows, cursor) where cursor is passed as `after` for the next page
+        and is None after the last one.
+        """
+        order = _order_cols(table_meta, order_by or table_meta.pk.attr)
+        if len({desc for _, desc in order}) > 1:
+            raise ValueError('keyset pages need every order_by attr sorted the same way')
+        where_sql, args, where_key = _where_sql(table_meta, where, args)
+        keyset = 0
+        if after is not None:
+            keyset = len(args) + 1
+            args.extend(after)
+        args.append(limit)
+        stmt = table_meta.statement(('page', where_key, order, keyset, len(args)),
+                                    _select_sql, table_meta, where_sql, order, keyset, len(args))
+        rows = list(map(clz._from_record, await table_meta.run(pg, 'fetch', stmt, *args, timeout=timeout)))
+        cursor = None
+        if len(rows) == limit:
+            cursor = tuple(getattr(rows[-1], attr) for attr, _ in order)
+        return rows, cursor
+    return page
+
+
 def table_all(table_meta):
     async def t_all(clz, pg: asyncpg.Connection):
-        return [clz(**r) for r in await pg.fetch(f'SELECT * FROM {table_meta.name}')]
+        return list(map(clz._from_record, await table_meta.run(pg, 'fetch', table_meta.select_all_sql)))
     return t_all
 
 
 def table_repr(table_meta):
     def trepr(self):
         rv = [table_meta.name, "("]
-        LOG.debug(table_meta.col_map)
         for k,v in table_meta.col_map.items():
             rv.append(k)
             rv.append("=")
@@ -121,12 +413,14 @@ def table_repr(table_meta):
 
 
 class Meta(type):
+    """
+    Entities are slotted, one slot per column. The Column declarations move to
+    table_meta, the class attributes become the slots.
+    """
 
     def __new__(cls, name, bases, dct):
-        clz = super().__new__(cls, name, bases, dct)
-
         cols = []
-        for k, v in dct.items():
+        for k, v in list(dct.items()):
             if k.startswith('_') or not (isinstance(v, Column) or v == Column):
                 continue
             if not isinstance(v, Column):
@@ -135,18 +429,32 @@ class Meta(type):
                 v.name = k
             v.attr = k
             cols.append(v)
-        
-        # TODO: class name
-        table_name = to_snake(name)
-        table_name = table_name[:-7] if table_name.endswith("_entity") else table_name
+            del dct[k]
+        if '__slots__' not in dct:
+            dct['__slots__'] = tuple(c.attr for c in cols)
+
+        clz = super().__new__(cls, name, bases, dct)
+
+        table_name = dct.get('_table')
+        if not table_name:
+            table_name = to_snake(name)
+            table_name = table_name[:-7] if table_name.endswith("_entity") else table_name
 
-        table_meta = TableMeta(table_name, cols)
+        table_meta = TableMeta(table_name, cols, prepare=dct.get('_prepare', False))
         clz.table_meta = table_meta
-    
+        from_record, table_meta.load = table_loaders(table_meta)
+
         clz.__init__        = table_init(table_meta)
+        clz._from_record    = classmethod(from_record)
         clz.create          = classmethod(table_create(table_meta))
+        clz.create_many     = classmethod(table_create_many(table_meta))
+        clz.upsert_many     = classmethod(table_upsert_many(table_meta))
+        clz.copy_in         = classmethod(table_copy_in(table_meta))
         clz.update          = table_update(table_meta)
         clz.all             = classmethod(table_all(table_meta))
+        clz.iter            = classmethod(table_iter(table_meta))
+        clz.count           = classmethod(table_count(table_meta))
+        clz.page            = classmethod(table_page(table_meta))
         clz.__repr__        = table_repr(table_meta)
 
         return clz
@@ -0,0 +1,174 @@
+"""
+Daily range partitions of the message table (migration 3). A partition covers
+[day, day + 1) of create_time and is named message_pYYYYMMDD. Retention and
+clearing detach and drop whole partitions instead of deleting rows.
+
+Rows outside every daily partition (a skewed clock, maintenance down for more
+than `days_ahead` days) land in message_default (migration 5) rather than
+failing their COPY batch. Creating a day's partition moves its rows out of
+the default one first.
+"""
+import asyncio
+import logging
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+
+
+LOG = logging.getLogger(__name__)
+
+PARTITION_PREFIX = 'message_p'
+DEFAULT_PARTITION = 'message_default'
+# every stored column, search is generated
+_COLUMNS = 'id, key, create_time, client_id, value, room_id'
+PARTITION_DAYS_AHEAD = 7
+# serialises partition maintenance across workers
+_LOCK_KEY = 0x6d657373
+
+
+def partition_name(day):
+    return f'{PARTITION_PREFIX}{day:%Y%m%d}'
+
+
+def partition_day(name):
+    return datetime.strptime(name[len(PARTITION_PREFIX):], '%Y%m%d').date()
+
+
+async def partitions(conn):
+    """
+    [(day, name)] of the attached message partitions, oldest first.
+    """
+    names = await conn.fetch('''
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'message'::regclass
+    ''')
+    return sorted((partition_day(r['relname']), r['relname']) for r in names
+                  if r['relname'].startswith(PARTITION_PREFIX))
+
+
+async def create_partitions(conn, first_day, last_day):
+    """
+    Creates the missing partitions for first_day through last_day, returns their names.
+    """
+    existing = {day for day, _ in await partitions(conn)}
+    has_default = await conn.fetchval('SELECT to_regclass($1) IS NOT NULL', DEFAULT_PARTITION)
+    created = []
+    day = first_day
+    while day <= last_day:
+        if day not in existing:
+            name = partition_name(day)
+            start, end = day.isoformat(), (day + timedelta(days=1)).isoformat()
+            # the default partition may not hold rows of a range being attached
+            moved = has_default and await conn.fetchval(f'''
+                SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION}
+                               WHERE create_time >= '{start}' AND create_time < '{end}')
+            ''')
+            if moved:
+                await conn.execute(f'''
+                    CREATE TEMP TABLE message_moved ON COMMIT DROP AS
+                        SELECT {_COLUMNS} FROM {DEFAULT_PARTITION}
+                        WHERE create_time >= '{start}' AND create_time < '{end}';
+                    DELETE FROM {DEFAULT_PARTITION} WHERE create_time >= '{start}' AND create_time < '{end}';
+                ''')
+            await conn.execute(f'''
+                CREATE TABLE {name} PARTITION OF message FOR VALUES FROM ('{start}') TO ('{end}')
+            ''')
+            if moved:
+                await conn.execute(f'''
+                    INSERT INTO message ({_COLUMNS}) SELECT {_COLUMNS} FROM message_moved;
+                    DROP TABLE message_moved;
+                ''')
+                LOG.info('moved rows of %s out of %s', day, DEFAULT_PARTITION)
+            created.append(name)
+        day += timedelta(days=1)
+    return created
+
+
+async def drop_partitions(conn, before=None):
+    """
+    Detaches and drops every partition ending on or before the day `before`, or
+    all of them, and deletes the same rows from the default partition. Returns
+    the days dropped.
+    """
+    if before is None:
+        await conn.execute(f'TRUNCATE {DEFAULT_PARTITION}')
+    else:
+        await conn.execute(f"DELETE FROM {DEFAULT_PARTITION} WHERE create_time < '{before.isoformat()}'")
+    dropped = []
+    for day, name in await partitions(conn):
+        if before is not None and day + timedelta(days=1) > before:
+            continue
+        await conn.execute(f'ALTER TABLE message DETACH PARTITION {name}')
+        await conn.execute(f'DROP TABLE {name}')
+        dropped.append(day)
+    return dropped
+
+
+async def maintain(conn, days_ahead=PARTITION_DAYS_AHEAD, retention_days=None, today=None):
+    """
+    Makes sure partitions exist up to `days_ahead` days from today and drops the
+    ones entirely older than `retention_days`. Returns (created, dropped).
+    """
+    today = today or date.today()
+    async with conn.transaction():
+        await conn.execute('SELECT pg_advisory_xact_lock($1)', _LOCK_KEY)
+        created = await create_partitions(conn, today, today + timedelta(days=days_ahead))
+        dropped = []
+        if retention_days is not None:
+            dropped = await drop_partitions(conn, before=today - timedelta(days=retention_days))
+    return created, dropped
+
+
+async def clear(conn, today=None):
+    """
+    Drops every message by dropping every partition, then recreates the ones from
+    today on so writes keep landing somewhere.
+    """
+    today = today or date.today()
+    async with conn.transaction():
+        await conn.execute('SELECT pg_advisory_xact_lock($1)', _LOCK_KEY)
+        dropped = await drop_partitions(conn)
+        upcoming = [day for day in dropped if day >= today]
+        await create_partitions(conn, today, max(upcoming, default=today))
+    return dropped
+
+
+class PartitionMaintainer:
+    """
+    Runs `maintain` at startup and every `interval` seconds.
+    """
+    def __init__(self, pgpool, days_ahead=PARTITION_DAYS_AHEAD, retention_days=None, interval=3600.0):
+        self.pgp = pgpool
+        self.days_ahead = days_ahead
+        self.retention_days = retention_days
+        self.interval = interval
+        self.stats = {'runs': 0, 'failures': 0, 'created': 0, 'dropped': 0}
+        self._task = None
+
+    async def run_once(self):
+        async with self.pgp.acquire() as conn:
+            created, dropped = await maintain(conn, self.days_ahead, self.retention_days)
+        self.stats['runs'] += 1
+        self.stats['created'] += len(created)
+        self.stats['dropped'] += len(dropped)
+        if created or dropped:
+            LOG.info('message partitions created: %s, dropped: %s', created, [partition_name(d) for d in dropped])
+
+    async def _run_forever(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                self.stats['failures'] += 1
+                LOG.exception('message partition maintenance failed')
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run_forever())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
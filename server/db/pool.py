@@ -0,0 +1,140 @@
+"""
+asyncpg pools sized from config and instrumented for acquire waits.
+
+`pool` config (all optional):
+    min_size, max_size, statement_cache_size, max_inactive_connection_lifetime
+        passed to asyncpg.create_pool
+    acquire_timeout
+        seconds an acquire may wait for a connection before asyncio.TimeoutError
+
+`db_replica` holds connection settings overriding `db` for a read-only pool,
+`app['pgpool_ro']` falls back to the primary pool without it.
+"""
+import asyncio
+import logging
+from time import perf_counter
+
+import asyncpg
+
+from metrics import REGISTRY
+
+
+LOG = logging.getLogger(__name__)
+
+_POOL_OPTIONS = {
+    'min_size': int,
+    'max_size': int,
+    'statement_cache_size': int,
+    'max_inactive_connection_lifetime': float,
+}
+
+ACQUIRE_BUCKETS = (.0001, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+
+
+def pool_options(config):
+    """
+    (create_pool kwargs, acquire timeout) from the `pool` config section.
+    """
+    pool = config.get('pool', {})
+    options = {k: convert(pool[k]) for k, convert in _POOL_OPTIONS.items() if k in pool}
+    timeout = pool.get('acquire_timeout')
+    return options, float(timeout) if timeout is not None else None
+
+
+async def create_pools(config, registry=REGISTRY):
+    """
+    Returns (primary, replica) InstrumentedPools, replica is None when `db_replica`
+    isn't configured.
+    """
+    options, timeout = pool_options(config)
+    primary = InstrumentedPool(
+        await asyncpg.create_pool(**config['db'], **options), 'primary', timeout, registry)
+    replica = None
+    if config.get('db_replica'):
+        try:
+            replica = InstrumentedPool(
+                await asyncpg.create_pool(**dict(config['db'], **config['db_replica']), **options),
+                'replica', timeout, registry)
+        except BaseException:
+            await primary.close()
+            raise
+    return primary, replica
+
+
+class _Acquire:
+    """
+    Same usage as asyncpg's acquire: awaited for a connection to release by hand
+    or used as an async context manager.
+    """
+    __slots__ = ('pool', 'timeout', 'conn')
+
+    def __init__(self, pool, timeout):
+        self.pool = pool
+        self.timeout = timeout
+        self.conn = None
+
+    def __await__(self):
+        return self.pool._acquire(self.timeout).__await__()
+
+    async def __aenter__(self):
+        self.conn = await self.pool._acquire(self.timeout)
+        return self.conn
+
+    async def __aexit__(self, *exc):
+        conn, self.conn = self.conn, None
+        await self.pool.release(conn)
+
+
+class InstrumentedPool:
+    """
+    Wraps an asyncpg pool, times every acquire and counts the ones that time out.
+    Pool size, connections in use and acquirers waiting are read at scrape time.
+    """
+    def __init__(self, pool, name, acquire_timeout=None, registry=REGISTRY):
+        self.pool = pool
+        self.name = name
+        self.acquire_timeout = acquire_timeout
+        self.waiting = 0
+        self._wait = registry.histogram(
+            'aiochat_db_pool_acquire_seconds', 'Time waited for a pooled connection', ('pool',),
+            buckets=ACQUIRE_BUCKETS).labels(name)
+        self._timeouts = registry.counter(
+            'aiochat_db_pool_acquire_timeouts_total', 'Acquires that gave up waiting', ('pool',)).labels(name)
+
+    def acquire(self, timeout=None):
+        return _Acquire(self, self.acquire_timeout if timeout is None else timeout)
+
+    async def _acquire(self, timeout):
+        self.waiting += 1
+        start = perf_counter()
+        try:
+            return await self.pool.acquire(timeout=timeout)
+        except asyncio.TimeoutError:
+            self._timeouts.inc()
+            LOG.warning('%s pool: no connection within %ss, %d in use', self.name, timeout, self.in_use)
+            raise
+        finally:
+            self.waiting -= 1
+            self._wait.observe(perf_counter() - start)
+
+    async def release(self, conn):
+        await self.pool.release(conn)
+
+    async def close(self):
+        await self.pool.close()
+
+    @property
+    def in_use(self):
+        return self.pool.get_size() - self.pool.get_idle_size()
+
+    def stats(self):
+        size = self.pool.get_size()
+        max_size = self.pool.get_max_size()
+        in_use = self.in_use
+        return {
+            'size': size,
+            'max_size': max_size,
+            'in_use': in_use,
+            'waiting': self.waiting,
+            'saturation': in_use / max_size if max_size else 0.0,
+        }
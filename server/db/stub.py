@@ -0,0 +1,87 @@
+"""
+In-memory stand-in for the asyncpg pool, selected with `"db": {"stub": true}`.
+
+Every statement succeeds and returns nothing, so the dispatcher, bots and
+websocket fan-out can be load tested without Postgres in the picture.
+"""
+
+
+class _Transaction:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class _Cursor:
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        raise StopAsyncIteration
+
+
+class StubConnection:
+    async def execute(self, *args, **kwargs):
+        return 'OK'
+
+    async def executemany(self, *args, **kwargs):
+        return None
+
+    async def fetch(self, *args, **kwargs):
+        return []
+
+    async def fetchrow(self, *args, **kwargs):
+        return None
+
+    async def fetchval(self, *args, **kwargs):
+        return None
+
+    async def copy_records_to_table(self, table_name, records, **kwargs):
+        return f'COPY {len(records)}'
+
+    def cursor(self, *args, **kwargs):
+        return _Cursor()
+
+    def transaction(self):
+        return _Transaction()
+
+    def is_in_transaction(self):
+        return False
+
+    async def add_listener(self, channel, callback):
+        pass
+
+    async def remove_listener(self, channel, callback):
+        pass
+
+
+class _Acquire:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __await__(self):
+        async def acquire():
+            return self.pool._conn
+        return acquire().__await__()
+
+    async def __aenter__(self):
+        return self.pool._conn
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class StubPool:
+    def __init__(self):
+        self._conn = StubConnection()
+
+    def acquire(self, timeout=None):
+        return _Acquire(self)
+
+    async def release(self, conn):
+        pass
+
+    async def close(self):
+        pass
@@ -1,96 +1,474 @@
+from asyncio import Semaphore
 from asyncio import create_task
 from asyncio import gather
 from asyncio import queues
-from dataclasses import dataclass
-from functools import wraps
+from asyncio import timeout as deadline
+from collections import OrderedDict
+from contextvars import ContextVar
+from time import monotonic
+from time import perf_counter
 import logging
+import zlib
 
+from commands import COMMANDS
 from event import Event
 from event import IntentEvent
+from metrics import REGISTRY
+from transport import InMemoryTransport
 
 LOG = logging.getLogger(__name__)
 
-# EventKind | * -> [qualname]
-_event_manifest = {}
+# overload policies, applied by `Dispatcher.submit` when the queue is full
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+REJECT = 'reject'
+_OVERLOAD_POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, REJECT)
 
-# INTENT -> [qualname]
-_intent_manifest = {}
+# dispatch modes: SHARED runs every worker off one queue, SHARDED gives each
+# worker its own lane and pins a client_id to a lane so its events stay ordered
+SHARED = 'shared'
+SHARDED = 'sharded'
+_MODES = (SHARED, SHARDED)
 
+# set for handlers running inside a dispatch worker
+_in_dispatch = ContextVar('in_dispatch', default=False)
 
-def subscribe(kind=None, intent=None):
+
+class DispatchRejected(Exception):
+    def __init__(self, event):
+        super().__init__(f'dispatch queue full, rejected {event.kind}')
+        self.event = event
+
+
+class HandlerTimeout(Exception):
+    def __init__(self, route):
+        super().__init__(f'{route.name} timed out after {route.timeout}s')
+
+
+def subscribe(kind=None, intent=None, remote=False, timeout=None, background=False, args=None):
+    """
+    Marks a bot method as a handler. The subscription is recorded on the function
+    itself and picked up by `Dispatcher.register` when an instance is registered.
+
+    Events published by other processes through the transport are only delivered
+    to `remote` handlers, side effects like persistence stay with the origin.
+
+    `timeout` overrides the dispatcher's handler timeout in seconds, 0 disables it.
+    `background` handlers run on the dispatcher's bounded task group instead of
+    holding up the worker, use it for handlers that do slow I/O.
+
+    `args` is the argument schema of an intent, a dict of argument name to
+    converter in positional order, see `commands.Command`.
+    """
     def wrapper(fn):
-        @wraps(fn)
-        def dec(*args, **kwargs):
-            return fn(*args, **kwargs)
+        subscriptions = list(getattr(fn, '_subscriptions', ()))
+        options = {'remote': remote, 'timeout': timeout, 'background': background}
         if kind:
-            methods = _event_manifest.get(kind, [])
-            methods.append(fn.__qualname__)
-            _event_manifest[kind] = methods
+            subscriptions.append(('kind', kind, options))
         elif intent:
-            methods = _intent_manifest.get(intent, [])
-            methods.append(fn.__qualname__)
-            _intent_manifest[intent] = methods
-
-        return dec
+            COMMANDS.declare(intent, args)
+            subscriptions.append(('intent', intent, options))
+        fn._subscriptions = tuple(subscriptions)
+        return fn
     return wrapper
 
 
+# type -> [(attr, ((route_type, route_key, options), ...))]
+_handler_specs = {}
+
+
+def handler_specs(bot_type):
+    specs = _handler_specs.get(bot_type)
+    if specs is None:
+        specs = []
+        for attr in dir(bot_type):
+            subscriptions = getattr(getattr(bot_type, attr, None), '_subscriptions', None)
+            if subscriptions:
+                specs.append((attr, subscriptions))
+        _handler_specs[bot_type] = specs
+    return specs
+
+
+class Route:
+    __slots__ = ('handler', 'name', 'remote', 'timeout', 'background',
+                 'failures', 'open_until', 'latency', 'errors', 'timeouts', 'short_circuits')
+
+    def __init__(self, handler, metrics, remote=False, timeout=None, background=False):
+        latency, errors, timeouts, short_circuits = metrics
+        self.handler = handler
+        self.name = handler.__qualname__
+        self.remote = remote
+        self.timeout = timeout
+        self.background = background
+        # circuit breaker: consecutive failures, and while open the monotonic
+        # time after which one call is let through to probe the handler
+        self.failures = 0
+        self.open_until = 0.0
+        self.latency = latency.labels(self.name)
+        self.errors = errors.labels(self.name)
+        self.timeouts = timeouts.labels(self.name)
+        self.short_circuits = short_circuits.labels(self.name)
+
+
 class Dispatcher:
-    def __init__(self):
+    def __init__(self, max_queue=0, overload=BLOCK, workers=4, mode=SHARED,
+                 transport=None, shared_kinds=('MessageEvent', 'IntentEvent', 'PresenceEvent'), dedup_size=10000,
+                 handler_timeout=5.0, max_background=256, breaker_threshold=5, breaker_reset=30.0,
+                 registry=REGISTRY):
+        """
+        `max_queue` bounds each lane; SHARED mode has a single lane, SHARDED mode
+        has one lane per worker. Events whose kind is in `shared_kinds` are also
+        published through `transport` to the dispatchers of other processes.
+
+        Handlers are cancelled after `handler_timeout` seconds (0 for no limit), at
+        most `max_background` background handlers run at once. A handler failing
+        or timing out `breaker_threshold` times in a row is skipped for
+        `breaker_reset` seconds, then gets one call to prove it recovered.
+        """
+        if overload not in _OVERLOAD_POLICIES:
+            raise ValueError(f'unknown overload policy {overload}, expected one of {_OVERLOAD_POLICIES}')
+        if mode not in _MODES:
+            raise ValueError(f'unknown dispatch mode {mode}, expected one of {_MODES}')
+        if workers < 1:
+            raise ValueError('dispatcher needs at least one worker')
+        if transport is None:
+            transport = InMemoryTransport()
+        self._overload = overload
+        self._workers = workers
+        self._mode = mode
+        self._transport = transport
+        self._shared_kinds = frozenset(shared_kinds)
+        self._seen = OrderedDict()
+        self._dedup_size = dedup_size
         self._tasks = []
-        self._bots = []
-        self._queue = queues.Queue()
+        self._pending_puts = set()
+        self._handler_timeout = handler_timeout or None
+        self._background = set()
+        self._background_slots = Semaphore(max_background)
+        self._breaker_threshold = breaker_threshold
+        self._breaker_reset = breaker_reset
+        # bot -> [(routes, route_key)]
+        self._bots = {}
+        # EventKind | * -> {bot: [Route]}
+        self._kind_routes = {}
+        # INTENT -> {bot: [Route]}
+        self._intent_routes = {}
+        lanes = workers if mode == SHARDED else 1
+        self._lanes = [queues.Queue(maxsize=max_queue) for _ in range(lanes)]
+        self.stats = {'dropped': 0, 'rejected': 0, 'remote': 0, 'duplicates': 0, 'background_waits': 0}
+
+        self._registry = registry
+        self._events_total = registry.counter(
+            'aiochat_dispatch_events_total', 'Events dispatched by kind', ('kind',))
+        # kind -> counter child
+        self._events_by_kind = {}
+        self._queue_wait = registry.histogram(
+            'aiochat_dispatch_queue_wait_seconds', 'Time from enqueue to dispatch')
+        self._handler_latency = registry.histogram(
+            'aiochat_dispatch_handler_seconds', 'Handler latency', ('handler',))
+        self._handler_errors = registry.counter(
+            'aiochat_dispatch_handler_errors_total', 'Handler exceptions', ('handler',))
+        self._handler_timeouts = registry.counter(
+            'aiochat_dispatch_handler_timeouts_total', 'Handlers cancelled on timeout', ('handler',))
+        self._handler_short_circuits = registry.counter(
+            'aiochat_dispatch_handler_short_circuits_total', 'Calls skipped by an open circuit breaker',
+            ('handler',))
+
+    def collect(self):
+        yield ('aiochat_dispatch_queue_depth', 'gauge', 'Events waiting per lane',
+               [({'lane': str(idx)}, lane.qsize()) for idx, lane in enumerate(self._lanes)])
+        for name, value in self.stats.items():
+            yield (f'aiochat_dispatch_{name}_total', 'counter', f'Events {name.replace("_", " ")}',
+                   [({}, value)])
+        yield ('aiochat_dispatch_background_handlers', 'gauge', 'Background handlers running',
+               [({}, len(self._background))])
+        now = monotonic()
+        yield ('aiochat_dispatch_open_circuits', 'gauge', 'Handlers with an open circuit breaker',
+               [({}, sum(1 for r in self._iter_routes() if r.open_until > now))])
+        for name, value in getattr(self._transport, 'stats', {}).items():
+            yield (f'aiochat_transport_{name}_total', 'counter', f'Transport events {name}',
+                   [({}, value)])
+
+    @property
+    def depth(self):
+        return sum(lane.qsize() for lane in self._lanes)
+
+    def _iter_routes(self):
+        for routes in (self._kind_routes, self._intent_routes):
+            for by_bot in routes.values():
+                for bot_routes in by_bot.values():
+                    yield from bot_routes
 
     def register(self, bot):
-        self._bots.append(bot)
+        if bot in self._bots:
+            return
+        metrics = (self._handler_latency, self._handler_errors,
+                   self._handler_timeouts, self._handler_short_circuits)
+        entries = []
+        for attr, subscriptions in handler_specs(type(bot)):
+            handler = getattr(bot, attr)
+            for route_type, route_key, options in subscriptions:
+                routes = self._kind_routes if route_type == 'kind' else self._intent_routes
+                timeout = options['timeout']
+                route = Route(handler, metrics, remote=options['remote'],
+                              timeout=self._handler_timeout if timeout is None else timeout or None,
+                              background=options['background'])
+                routes.setdefault(route_key, {}).setdefault(bot, []).append(route)
+                entries.append((routes, route_key))
+        self._bots[bot] = entries
 
     def unregister(self, bot):
-        self._bots.remove(bot)
+        for routes, route_key in self._bots.pop(bot, ()):
+            by_bot = routes.get(route_key)
+            if by_bot is None:
+                continue
+            by_bot.pop(bot, None)
+            if not by_bot:
+                del routes[route_key]
 
     async def submit(self, event):
-        await self._queue.put(event)
+        """
+        Enqueues an event. When the queue is full the overload policy decides:
+        BLOCK waits for room, DROP_OLDEST evicts the head of the queue, DROP_NEWEST
+        discards `event` and REJECT raises `DispatchRejected` to the caller.
+        Only events queued here are published to other processes.
+        """
+        self._remember(event.key)
+        item = (event, False, perf_counter())
+        queue = self._lane_for(event)
+        if queue.full():
+            if self._overload == REJECT:
+                self.stats['rejected'] += 1
+                raise DispatchRejected(event)
+            elif self._overload == BLOCK and not _in_dispatch.get():
+                await queue.put(item)
+            elif not self._put_nowait(queue, item):
+                return
+        else:
+            queue.put_nowait(item)
+
+        if event.kind in self._shared_kinds:
+            self._transport.publish(event)
+
+    def receive(self, event):
+        """
+        Entry point for events published by other processes, never blocks the transport.
+        """
+        if not self._remember(event.key):
+            self.stats['duplicates'] += 1
+            return
+        self.stats['remote'] += 1
+        self._put_nowait(self._lane_for(event), (event, True, perf_counter()))
+
+    def _put_nowait(self, queue, item):
+        """
+        False when the overload policy dropped `item`.
+        """
+        if not queue.full():
+            queue.put_nowait(item)
+        elif self._overload == DROP_OLDEST:
+            queue.get_nowait()
+            queue.task_done()
+            queue.put_nowait(item)
+            self.stats['dropped'] += 1
+        elif self._overload == BLOCK:
+            # a handler blocking on its own dispatcher's queue can deadlock every
+            # worker, so park the put in a task instead of waiting on it
+            task = create_task(queue.put(item))
+            self._pending_puts.add(task)
+            task.add_done_callback(self._pending_puts.discard)
+        else:
+            self.stats['dropped'] += 1
+            return False
+        return True
+
+    def _remember(self, key):
+        """
+        Records `key` as dispatched here, False if it already was.
+        """
+        seen = self._seen
+        if key in seen:
+            return False
+        seen[key] = None
+        if len(seen) > self._dedup_size:
+            seen.popitem(last=False)
+        return True
+
+    def _lane_for(self, event):
+        lanes = self._lanes
+        if len(lanes) == 1:
+            return lanes[0]
+        return lanes[zlib.crc32((event.client_id or '').encode()) % len(lanes)]
 
     def start(self):
         if self._tasks:
             return
-        for _ in range(4):
-            self._tasks.append(create_task(self._run_forever()))
+        for idx in range(self._workers):
+            lane = self._lanes[idx % len(self._lanes)]
+            self._tasks.append(create_task(self._run_forever(lane)))
+
+    async def open(self, transport=None):
+        """
+        Starts the workers and connects the transport, replacing it when one is given.
+        """
+        if transport is not None:
+            self._transport = transport
+        # not in __init__, dispatchers that never run would export duplicate families
+        self._registry.register_collector(self.collect)
+        self.start()
+        await self._transport.start(self.receive)
 
-    async def _run_forever(self):
+    async def drain(self):
+        """
+        Waits until every queued event, parked put and background handler is done,
+        including the events their handlers submit meanwhile.
+        """
         while True:
-            event = await self._queue.get()
-            await self._on_event(event)
+            for lane in self._lanes:
+                await lane.join()
+            pending = self._pending_puts | self._background
+            if not pending:
+                return
+            await gather(*pending, return_exceptions=True)
 
-    async def _on_event(self, e):
-        names = list(_event_manifest.get(e.kind, []))
-        names.extend(_event_manifest.get('*', []))
+    async def close(self, drain_timeout=5.0):
+        """
+        Disconnects the transport, gives the workers `drain_timeout` seconds to
+        finish what is queued and cancels whatever is left.
+        """
+        self._registry.unregister_collector(self.collect)
+        await self._transport.close()
+        if drain_timeout and any(not task.done() for task in self._tasks):
+            try:
+                async with deadline(drain_timeout):
+                    await self.drain()
+            except TimeoutError:
+                LOG.warning('dispatcher not drained after %ss, %d events dropped', drain_timeout, self.depth)
+        tasks = self._tasks + list(self._background)
+        for task in tasks:
+            task.cancel()
+        await gather(*tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _routes_for(self, e, remote):
+        matched = []
+        for routes, route_key in ((self._kind_routes, e.kind), (self._kind_routes, '*')):
+            by_bot = routes.get(route_key)
+            if by_bot:
+                for bot_routes in by_bot.values():
+                    matched.extend(bot_routes)
         if isinstance(e, IntentEvent):
-            names.extend(_intent_manifest.get(e.action, []))
-
-        coroutines = []
-        _names = []
-        for bot in self._bots:
-            instance_name = type(bot).__name__ + "."
-            for name in names:
-                if name.startswith(instance_name):
-                    _names.append(instance_name)
-                    method_name = name[len(instance_name):]
-                    method = getattr(bot, method_name)
-                    try:
-                        coroutines.append(method(e))
-                    except:
-                        LOG.error(f'failed to publish {e} to {name}')
-
-        LOG.debug(f'event dispatch: {e}')
-        LOG.debug(f'matched: {names}')
-        LOG.debug(f'available: {[type(b) for b in self._bots]}')
-        LOG.debug(f'available matched: {_names}')
-        
-        results = await gather(*coroutines, return_exceptions=True)    
-
-        for idx, result in enumerate(results):
-            if isinstance(result, Event):
-                await self.submit(result)
-            elif isinstance(result, Exception):
-                LOG.warning(f'error in gather, {_names[idx]}\n{e}\n{result}')
+            by_bot = self._intent_routes.get(e.action)
+            if by_bot:
+                for bot_routes in by_bot.values():
+                    matched.extend(bot_routes)
+        if remote:
+            return [r for r in matched if r.remote]
+        return matched
+
+    async def _run_forever(self, lane):
+        _in_dispatch.set(True)
+        queue_wait = self._queue_wait
+        while True:
+            event, remote, enqueued = await lane.get()
+            queue_wait.observe(perf_counter() - enqueued)
+            try:
+                await self._on_event(event, remote)
+            finally:
+                lane.task_done()
+
+    async def _on_event(self, e, remote=False):
+        counter = self._events_by_kind.get(e.kind)
+        if counter is None:
+            counter = self._events_by_kind[e.kind] = self._events_total.labels(e.kind)
+        counter.inc()
+
+        routes = self._routes_for(e, remote)
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug('event dispatch: %s matched: %s', e, [r.name for r in routes])
+
+        inline = []
+        for route in routes:
+            if route.background:
+                await self._spawn(route, e)
+            else:
+                inline.append(route)
+
+        results = await gather(*[self._call(route, e) for route in inline], return_exceptions=True)
+
+        for route, result in zip(inline, results):
+            await self._handle_result(route, e, result)
+
+    async def _handle_result(self, route, e, result):
+        if isinstance(result, Event):
+            await self.submit(result)
+        elif isinstance(result, Exception):
+            LOG.warning('error in gather, %s\n%s\n%s', route.name, e, result)
+
+    async def _spawn(self, route, e):
+        """
+        Runs a background handler once a slot is free. Waiting for a slot is the
+        only time a background handler holds up the worker.
+        """
+        slots = self._background_slots
+        if slots.locked():
+            self.stats['background_waits'] += 1
+        await slots.acquire()
+        task = create_task(self._run_background(route, e))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _run_background(self, route, e):
+        try:
+            try:
+                result = await self._call(route, e)
+            except Exception as ex:
+                result = ex
+            await self._handle_result(route, e, result)
+        finally:
+            self._background_slots.release()
+
+    async def _call(self, route, e):
+        if route.open_until:
+            if monotonic() < route.open_until:
+                route.short_circuits.inc()
+                return None
+            # half open, this call decides whether the breaker closes
+            route.open_until = 0.0
+        start = perf_counter()
+        cm = None
+        try:
+            if route.timeout:
+                async with deadline(route.timeout) as cm:
+                    result = await route.handler(e)
+            else:
+                result = await route.handler(e)
+        except TimeoutError:
+            if cm is None or not cm.expired():
+                # raised by the handler itself, e.g. a pool acquire timing out
+                route.errors.inc()
+                self._failed(route)
+                raise
+            route.timeouts.inc()
+            self._failed(route)
+            raise HandlerTimeout(route) from None
+        except DispatchRejected:
+            # the handler is fine, the queue it submitted to is full
+            raise
+        except Exception:
+            route.errors.inc()
+            self._failed(route)
+            raise
+        finally:
+            route.latency.observe(perf_counter() - start)
+        route.failures = 0
+        return result
 
+    def _failed(self, route):
+        route.failures += 1
+        if self._breaker_threshold and route.failures >= self._breaker_threshold:
+            if not route.open_until:
+                LOG.warning('%s failed %s times in a row, skipping it for %ss',
+                            route.name, route.failures, self._breaker_reset)
+            route.open_until = monotonic() + self._breaker_reset
@@ -1,87 +1,191 @@
 from abc import ABC
-from dataclasses import asdict
 from dataclasses import dataclass
-from time import time as time_s
+from dataclasses import field
+from dataclasses import fields
+from time import time_ns
 from typing import Optional
-from uuid import uuid4
 import json
+import os
+
+from commands import COMMANDS
+from helpers import dumps
 
 
 
 def time_m():
-    return int(time_s() * 1000)
+    return time_ns() // 1_000_000
+
+
+class KeyGenerator:
+    """
+    Event keys: 12 hex digits of unix millis, 8 of node, 6 of sequence. Keys from
+    one process are strictly increasing and keys from any process sort by time,
+    so a key works as a keyset cursor. The node is the pid plus random bits and
+    is drawn again in forked children.
+    """
+    _SEQ_MAX = 0xffffff
+
+    def __init__(self):
+        self.reseed()
+
+    def reseed(self):
+        node = ((os.getpid() & 0xffff) << 16) | int.from_bytes(os.urandom(2), 'big')
+        self._node = f'{node:08x}'
+        self._last = 0
+        self._seq = 0
+
+    def next(self):
+        """
+        Returns (key, create_time), both from one clock read.
+        """
+        now = time_ns() // 1_000_000
+        if now > self._last:
+            self._last = now
+            self._seq = 0
+        else:
+            # same millisecond or the clock went back, stay on the last one
+            self._seq += 1
+            if self._seq > self._SEQ_MAX:
+                self._last += 1
+                self._seq = 0
+            now = self._last
+        return f'{now:012x}{self._node}{self._seq:06x}', now
+
+
+_keys = KeyGenerator()
+os.register_at_fork(after_in_child=_keys.reseed)
+new_key = _keys.next
+
+
+def key_time(key):
+    """
+    The unix millis a key was generated at.
+    """
+    return int(key[:12], 16)
 
 
-@dataclass
+def key_node(key):
+    """
+    The node of the process a key was generated in.
+    """
+    return key[12:20]
+
+
+def local_node():
+    return _keys._node
+
+
+# room a socket joins on open and messages go to when none is given
+DEFAULT_ROOM = 'lobby'
+
+
+# kind -> event class, filled in as event classes are defined
+_events = {}
+
+
+@dataclass(slots=True)
 class Event(ABC):
     key: str
     create_time: int
     client_id: str
+    # encoded form, set by `to_json`
+    _json: Optional[str] = field(default=None, init=False, repr=False, compare=False)
+
+    kind = 'Event'
+    _fields = ()
 
-    @property
-    def kind(self):
-        return self.__class__.__name__
+    def __init_subclass__(cls, **kwargs):
+        super(Event, cls).__init_subclass__(**kwargs)
+        cls.kind = cls.__name__
+        # dataclass(slots=True) replaces the class it decorates, the last one
+        # defined under a name is the one that sticks
+        _events[cls.kind] = cls
 
     def as_dict(self):
-        rv = asdict(self)
+        cls = type(self)
+        names = cls.__dict__.get('_fields')
+        if not names:
+            names = cls._fields = tuple(f.name for f in fields(cls) if f.init)
+        rv = {name: getattr(self, name) for name in names}
         rv['kind'] = self.kind
         return rv
 
     def to_json(self):
-        return json.dumps(self.as_dict())
+        """
+        Events are not mutated once submitted, so the encoding is computed once and
+        shared by every recipient.
+        """
+        if self._json is None:
+            self._json = dumps(self.as_dict())
+        return self._json
 
 
-@dataclass
+@dataclass(slots=True)
 class MessageEvent(Event):
     message: str
+    room_id: str
 
     @classmethod
-    def of(cls, client_id, message):
-        return cls(str(uuid4()), time_m(), client_id, message)
+    def of(cls, client_id, message, room_id=DEFAULT_ROOM):
+        return cls(*new_key(), client_id, message, room_id)
+
 
+@dataclass(slots=True)
 class WsMessageEvent(MessageEvent):
     pass
 
 
-@dataclass
+@dataclass(slots=True)
 class IntentEvent(Event):
     message: str
     # target: str
     action: str
     args: list
     kwargs: dict
+    room_id: str
 
     @classmethod
-    def fromMessage(cls, event: MessageEvent) -> Optional['IntentEvent']:
+    def of(cls, client_id, message, action, args, kwargs, room_id=DEFAULT_ROOM):
+        return cls(*new_key(), client_id, message, action, args, kwargs, room_id)
+
+    @classmethod
+    def fromMessage(cls, event: MessageEvent, commands=COMMANDS) -> Optional['IntentEvent']:
+        """
+        None when the message is not a command, raises `commands.CommandError`
+        when it is one nobody handles or its arguments don't fit.
+        """
         message = event.message.strip()
         if not message.startswith('.'):
             return None
-        parts = message.split()
-        args = []
-        kwargs = {}
-        for arg in parts[1:]:
-            if '=' in arg:
-                kv = arg.split('=')
-                kwargs[kv[0]] = kv[1]
-            else:
-                args.append(arg)
-        return cls(str(uuid4()), time_m(), event.message, event.client_id, parts[0][1:], args, kwargs)
-
-
-@dataclass
+        action, args, kwargs = commands.parse(message)
+        return cls.of(event.client_id, message, action, args, kwargs, event.room_id)
+
+
+@dataclass(slots=True)
+class ErrorEvent(Event):
+    message: str
+
+    @classmethod
+    def of(cls, client_id, message):
+        return cls(*new_key(), client_id, message)
+
+
+@dataclass(slots=True)
+class PresenceEvent(Event):
+    status: str
+
+    @classmethod
+    def of(cls, client_id, status):
+        return cls(*new_key(), client_id, status)
+
+
+@dataclass(slots=True)
 class LifecycleEvent(Event):
     phase: str
 
     @classmethod
     def of(cls, client_id, phase):
-        return cls(str(uuid4()), time_m(), client_id, phase)
-
-
-# TODO: maintain this
-_events = {
-    MessageEvent.__name__: MessageEvent,
-    IntentEvent.__name__: IntentEvent
-}
+        return cls(*new_key(), client_id, phase)
 
 
 def parse(message):
@@ -89,8 +193,10 @@ def parse(message):
         msg = json.loads(message)
     except:
         return None
-    class_ = _events.get(msg.get('kind', ''), None)
-    del msg['kind']
+    class_ = _events.get(msg.pop('kind', ''), None)
     if class_:
-        return class_(**msg)
+        try:
+            return class_(**msg)
+        except TypeError:
+            return None
     return None
@@ -0,0 +1,88 @@
+"""
+Wire formats for events going out to websockets, picked by the client at `open`:
+
+    json      the full event as JSON text, the default and the fallback
+    compact   JSON text with short field and kind codes
+    msgpack   MessagePack binary frames with the compact codes, if msgpack is installed
+"""
+from helpers import dumps
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON = 'json'
+COMPACT = 'compact'
+MSGPACK = 'msgpack'
+
+FIELD_CODES = {
+    'key': 'k',
+    'create_time': 't',
+    'client_id': 'c',
+    'message': 'm',
+    'room_id': 'r',
+    'status': 's',
+    'action': 'a',
+    'args': 'p',
+    'kwargs': 'o',
+    'phase': 'h',
+    'kind': 'e',
+}
+
+KIND_CODES = {
+    'MessageEvent': 'M',
+    'WsMessageEvent': 'W',
+    'IntentEvent': 'I',
+    'ErrorEvent': 'E',
+    'PresenceEvent': 'P',
+    'LifecycleEvent': 'L',
+}
+
+
+def formats():
+    return (JSON, COMPACT, MSGPACK) if msgpack is not None else (JSON, COMPACT)
+
+
+def negotiate(requested):
+    """
+    The format to use for a client asking for `requested`, JSON unless it is supported.
+    """
+    return requested if requested in formats() else JSON
+
+
+# event class -> ((field, code), ...)
+_class_codes = {}
+
+
+def compact(event):
+    cls = type(event)
+    codes = _class_codes.get(cls)
+    if codes is None:
+        names = [name for name in event.as_dict() if name != 'kind']
+        codes = _class_codes[cls] = tuple((name, FIELD_CODES.get(name, name)) for name in names)
+    rv = {code: getattr(event, name) for name, code in codes}
+    rv[FIELD_CODES['kind']] = KIND_CODES.get(cls.kind, cls.kind)
+    return rv
+
+
+def encode(event, fmt):
+    """
+    str for the text formats, bytes for msgpack.
+    """
+    if fmt == COMPACT:
+        return dumps(compact(event))
+    elif fmt == MSGPACK:
+        return msgpack.packb(compact(event))
+    return event.to_json()
+
+
+def batch(frames, fmt):
+    """
+    One frame holding an array of already encoded `frames`.
+    """
+    if fmt == MSGPACK:
+        return msgpack.Packer().pack_array_header(len(frames)) + b''.join(frames)
+    return f'[{",".join(frames)}]'
+
@@ -1,4 +1,11 @@
 from datetime import datetime
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def _jsonable(v):
     if isinstance(v, datetime):
@@ -9,4 +16,13 @@ def _jsonable(v):
 def to_dict(record):
     return {
         k: _jsonable(v) for k,v in record.items()
-    }
\ No newline at end of file
+    }
+
+
+def dumps(obj):
+    """
+    json.dumps, through orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
@@ -0,0 +1,88 @@
+"""
+Message history queries shared by the history endpoint and the recent history buffer.
+"""
+from datetime import datetime
+
+
+HISTORY_DEFAULT_LIMIT = 100
+HISTORY_MAX_LIMIT = 1000
+_HISTORY_COLUMNS = 'id, key, create_time, value, client_id, room_id'
+
+
+def parse_cursor(cursor):
+    """
+    A history cursor is `<create_time isoformat>,<event key>`, or just the
+    timestamp. Keys are unique and known before a message is stored, so pages
+    served from the recent history buffer carry them too.
+    """
+    try:
+        if ',' in cursor:
+            create_time, key = cursor.rsplit(',', 1)
+            if not key:
+                raise ValueError(key)
+            return datetime.fromisoformat(create_time), key
+        return datetime.fromisoformat(cursor), None
+    except ValueError:
+        raise ValueError(f'invalid cursor: {cursor}')
+
+
+def format_cursor(create_time, key=None):
+    if isinstance(create_time, str):
+        create_time = datetime.fromisoformat(create_time)
+    if key is None:
+        return create_time.isoformat()
+    return f'{create_time.isoformat()},{key}'
+
+
+def row_before(row, cursor):
+    """
+    True when `row` sorts before `cursor`, by timestamp alone for a cursor without a key.
+    """
+    create_time, key = cursor
+    if key is None:
+        return row['create_time'] < create_time
+    return (row['create_time'], row['key']) < (create_time, key)
+
+
+def row_after(row, cursor):
+    create_time, key = cursor
+    if key is None:
+        return row['create_time'] > create_time
+    return (row['create_time'], row['key']) > (create_time, key)
+
+
+def _keyset(op, cursor, args):
+    create_time, key = cursor
+    args.append(create_time)
+    if key is None:
+        return f'create_time {op} ${len(args)}'
+    args.append(key)
+    # the plain create_time bound lets the create_time indexes drive the scan
+    return f'create_time {op}= ${len(args) - 1} AND (create_time, key) {op} (${len(args) - 1}, ${len(args)})'
+
+
+def history_query(before=None, after=None, limit=None, room_id=None):
+    """
+    Keyset query over (create_time, key), always returning rows oldest first. Without
+    `after` the newest `limit` rows (older than `before`) are selected. `room_id`
+    limits the page to one room, all rooms otherwise.
+    """
+    args = []
+    where = []
+    if room_id is not None:
+        args.append(room_id)
+        where.append(f'room_id = ${len(args)}')
+    if before:
+        where.append(_keyset('<', before, args))
+    if after:
+        where.append(_keyset('>', after, args))
+    where_sql = f' WHERE {" AND ".join(where)}' if where else ''
+    limit_sql = ''
+    if limit is not None:
+        args.append(limit)
+        limit_sql = f' LIMIT ${len(args)}'
+
+    if after or limit is None:
+        return f'SELECT {_HISTORY_COLUMNS} FROM message{where_sql} ORDER BY create_time, key{limit_sql}', args
+    return (f'SELECT * FROM (SELECT {_HISTORY_COLUMNS} FROM message{where_sql} '
+            f'ORDER BY create_time DESC, key DESC{limit_sql}) page ORDER BY create_time, key'), args
@@ -0,0 +1,291 @@
+"""
+Pre-forking launcher. The master forks `workers` processes that each bind the
+listening address with SO_REUSEPORT and run their own app (pg pool, Dispatcher,
+bots). Workers report health to the master through a pipe; the master respawns
+workers that exit or stop reporting.
+
+Signals to the master:
+    SIGHUP          rolling restart, one worker at a time
+    SIGUSR1         log every worker's last health report
+    SIGTERM/SIGINT  graceful shutdown of every worker
+"""
+import asyncio
+import json
+import logging
+import os
+import select
+import signal
+import time
+from asyncio import create_task
+from asyncio import sleep
+from contextlib import suppress
+
+from aiohttp import web
+import uvloop
+
+from transport import run_broker
+
+
+LOG = logging.getLogger(__name__)
+
+
+class WorkerProcess:
+    def __init__(self, index, pid, fd):
+        self.index = index
+        self.pid = pid
+        self.fd = fd
+        self.started = time.monotonic()
+        self.last_report = None
+        self.status = {}
+        self._partial = b''
+
+    @property
+    def ready(self):
+        return self.last_report is not None
+
+    def read_reports(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return True
+        if not data:
+            return False
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            with suppress(ValueError):
+                self.status = json.loads(line)
+                self.last_report = time.monotonic()
+        return True
+
+
+class Master:
+    def __init__(self, app_factory, health_status, host, port, workers, broker_path=None,
+                 heartbeat_interval=2.0, heartbeat_timeout=30.0, shutdown_timeout=30.0):
+        """
+        `app_factory(worker=index)` builds a worker's app. With `broker_path` the master
+        also forks a unix socket broker for the workers' UnixSocketTransport.
+        """
+        self.app_factory = app_factory
+        self.health_status = health_status
+        self.host = host
+        self.port = port
+        self.n_workers = workers
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.broker_path = broker_path
+        self.broker_pid = None
+        # worker index -> WorkerProcess
+        self.workers = {}
+        self._stopping = False
+        self._restart_requested = False
+        self._report_requested = False
+
+    def run(self):
+        signal.signal(signal.SIGHUP, lambda *_: self._request_restart())
+        signal.signal(signal.SIGUSR1, lambda *_: self._request_report())
+        signal.signal(signal.SIGTERM, lambda *_: self._request_stop())
+        signal.signal(signal.SIGINT, lambda *_: self._request_stop())
+        if self.broker_path:
+            self._spawn_broker()
+        for index in range(self.n_workers):
+            self.workers[index] = self._spawn(index)
+        LOG.info('master %d running %d workers on %s:%d', os.getpid(), self.n_workers, self.host, self.port)
+
+        while not self._stopping:
+            self._poll(1.0)
+            self._reap()
+            self._check_heartbeats()
+            if self._restart_requested:
+                self._restart_requested = False
+                self._rolling_restart()
+            if self._report_requested:
+                self._report_requested = False
+                self._log_status()
+        self._stop_all()
+
+    def _request_restart(self):
+        self._restart_requested = True
+
+    def _request_report(self):
+        self._report_requested = True
+
+    def _log_status(self):
+        now = time.monotonic()
+        for index, worker in sorted(self.workers.items()):
+            if worker.last_report is None:
+                LOG.info('worker %d (pid %d): no report yet', index, worker.pid)
+            else:
+                LOG.info('worker %d (pid %d) reported %.1fs ago: %s', index, worker.pid,
+                         now - worker.last_report, json.dumps(worker.status))
+
+    def _request_stop(self):
+        self._stopping = True
+
+    def _spawn_broker(self):
+        pid = os.fork()
+        if pid == 0:
+            for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+                signal.signal(sig, signal.SIG_DFL)
+            code = 0
+            try:
+                asyncio.run(_serve_broker(self.broker_path))
+            except BaseException:
+                LOG.exception('broker crashed')
+                code = 1
+            finally:
+                os._exit(code)
+        # workers connect as soon as they start, give the broker a head start
+        for _ in range(50):
+            if os.path.exists(self.broker_path):
+                break
+            time.sleep(0.1)
+        self.broker_pid = pid
+        LOG.info('spawned broker on %s as pid %d', self.broker_path, pid)
+
+    def _spawn(self, index):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+                signal.signal(sig, signal.SIG_DFL)
+            code = 0
+            try:
+                run_worker(self.app_factory, self.health_status, index, self.host, self.port,
+                           write_fd, self.heartbeat_interval)
+            except BaseException:
+                LOG.exception('worker %d crashed', index)
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        LOG.info('spawned worker %d as pid %d', index, pid)
+        return WorkerProcess(index, pid, read_fd)
+
+    def _poll(self, timeout):
+        by_fd = {w.fd: w for w in self.workers.values()}
+        with suppress(InterruptedError):
+            readable, _, _ = select.select(list(by_fd), [], [], timeout)
+            for fd in readable:
+                by_fd[fd].read_reports()
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid == self.broker_pid:
+                self.broker_pid = None
+                if not self._stopping:
+                    LOG.warning('broker exited with %d, respawning', status)
+                    self._spawn_broker()
+                continue
+            for index, worker in list(self.workers.items()):
+                if worker.pid == pid:
+                    os.close(worker.fd)
+                    if self._stopping:
+                        del self.workers[index]
+                    else:
+                        LOG.warning('worker %d (pid %d) exited with %d, respawning', index, pid, status)
+                        self.workers[index] = self._spawn(index)
+
+    def _check_heartbeats(self):
+        now = time.monotonic()
+        for worker in self.workers.values():
+            last = worker.last_report or worker.started
+            if now - last > self.heartbeat_timeout:
+                LOG.warning('worker %d (pid %d) missed heartbeats for %.0fs, killing', worker.index, worker.pid, now - last)
+                with suppress(ProcessLookupError):
+                    os.kill(worker.pid, signal.SIGKILL)
+                # the reaper respawns it
+                worker.last_report = now
+
+    def _rolling_restart(self):
+        LOG.info('rolling restart of %d workers', len(self.workers))
+        for index in list(self.workers):
+            old = self.workers[index]
+            new = self._spawn(index)
+            # the replacement binds the same port with SO_REUSEPORT, wait until it
+            # serves before draining the old worker
+            deadline = time.monotonic() + self.heartbeat_timeout
+            while not new.ready and time.monotonic() < deadline and not self._stopping:
+                readable, _, _ = select.select([new.fd], [], [], 0.5)
+                if readable:
+                    new.read_reports()
+            self.workers[index] = new
+            self._terminate(old)
+            if self._stopping:
+                return
+
+    def _terminate(self, worker):
+        with suppress(ProcessLookupError):
+            os.kill(worker.pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.shutdown_timeout
+        while time.monotonic() < deadline:
+            pid, _ = os.waitpid(worker.pid, os.WNOHANG)
+            if pid:
+                break
+            time.sleep(0.1)
+        else:
+            LOG.warning('worker %d (pid %d) did not stop in time, killing', worker.index, worker.pid)
+            with suppress(ProcessLookupError):
+                os.kill(worker.pid, signal.SIGKILL)
+            os.waitpid(worker.pid, 0)
+        os.close(worker.fd)
+
+    def _stop_all(self):
+        LOG.info('stopping %d workers', len(self.workers))
+        for worker in list(self.workers.values()):
+            with suppress(ProcessLookupError):
+                os.kill(worker.pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.shutdown_timeout
+        while self.workers and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for worker in self.workers.values():
+            with suppress(ProcessLookupError):
+                os.kill(worker.pid, signal.SIGKILL)
+        if self.broker_pid:
+            with suppress(ProcessLookupError):
+                os.kill(self.broker_pid, signal.SIGTERM)
+            os.waitpid(self.broker_pid, 0)
+            with suppress(FileNotFoundError):
+                os.unlink(self.broker_path)
+
+
+async def _serve_broker(path):
+    server = await run_broker(path)
+    async with server:
+        await server.serve_forever()
+
+
+def run_worker(app_factory, health_status, index, host, port, report_fd, heartbeat_interval):
+    # a stalled master must never block the worker's event loop
+    os.set_blocking(report_fd, False)
+    uvloop.install()
+    app = app_factory(worker=index)
+
+    async def report_forever(app):
+        while True:
+            status = health_status(app)
+            try:
+                os.write(report_fd, json.dumps(status).encode() + b'\n')
+            except BlockingIOError:
+                pass
+            await sleep(heartbeat_interval)
+
+    async def start_reporting(app):
+        app['heartbeat'] = create_task(report_forever(app))
+
+    async def stop_reporting(app):
+        app['heartbeat'].cancel()
+
+    app.on_startup.append(start_reporting)
+    app.on_shutdown.append(stop_reporting)
+    web.run_app(app, host=host, port=port, reuse_port=True, print=None)
@@ -0,0 +1,51 @@
+"""
+Full-text message search over the `search` tsvector column (migration 2), which
+message_search_idx indexes with GIN so every search starts from an index scan.
+"""
+
+# must match the configuration the generated column is built with
+SEARCH_CONFIG = 'english'
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+_SEARCH_COLUMNS = 'id, create_time, value, client_id, room_id'
+
+
+def parse_search_cursor(cursor):
+    """
+    A search cursor is `<rank>,<id>` of the last hit of the previous page.
+    """
+    try:
+        rank, id_ = cursor.split(',', 1)
+        return float(rank), int(id_)
+    except ValueError:
+        raise ValueError(f'invalid cursor: {cursor}')
+
+
+def format_search_cursor(rank, id_):
+    return f'{rank!r},{id_}'
+
+
+def search_query(text, room_id=None, client_id=None, after=None, limit=SEARCH_DEFAULT_LIMIT):
+    """
+    Best ranked hits first, ties newest first. `text` takes web search syntax:
+    quoted phrases, `or`, and `-` to exclude a word. `after` is the (rank, id)
+    of the last hit already seen.
+    """
+    args = [text]
+    where = ['search @@ q']
+    if room_id is not None:
+        args.append(room_id)
+        where.append(f'room_id = ${len(args)}')
+    if client_id is not None:
+        args.append(client_id)
+        where.append(f'client_id = ${len(args)}')
+    page = ''
+    if after is not None:
+        args.extend(after)
+        page = f' WHERE (rank, id) < (${len(args) - 1}::real, ${len(args)})'
+    args.append(limit)
+    return (f'SELECT * FROM ('
+            f'SELECT {_SEARCH_COLUMNS}, ts_rank(search, q) AS rank '
+            f"FROM message, websearch_to_tsquery('{SEARCH_CONFIG}', $1) q "
+            f'WHERE {" AND ".join(where)}'
+            f') hits{page} ORDER BY rank DESC, id DESC LIMIT ${len(args)}'), args
@@ -0,0 +1,116 @@
+import logging
+
+from bots import Bot
+from dispatch import DispatchRejected
+from dispatch import subscribe
+from event import PresenceEvent
+from event import key_node
+from event import local_node
+
+
+LOG = logging.getLogger(__name__)
+
+ONLINE = 'online'
+OFFLINE = 'offline'
+# a process gained or lost a client that has sessions on other processes too,
+# only other registries act on these
+JOINED = 'joined'
+LEFT = 'left'
+VISIBLE = (ONLINE, OFFLINE)
+
+
+class SessionRegistry(Bot):
+    """
+    Connected clients of this process by client_id. A client may have several
+    sessions (tabs), it comes online with the first and goes offline with the last.
+    Registering, unregistering and finding a client's connections are dict operations.
+
+    Other processes' clients are followed through their PresenceEvents, so a
+    client is online while any process has a session of it. A process that
+    dies without saying so leaves its clients online here.
+    """
+    def __init__(self):
+        self.client_id = 'SessionRegistry'
+        # client_id -> {Connection: None}, an insertion ordered set of tabs
+        self._sessions = {}
+        # client_id -> {node} of the other processes it has sessions on
+        self._remote = {}
+
+    def __contains__(self, client_id):
+        return client_id in self._sessions
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def connections(self, client_id):
+        return tuple(self._sessions.get(client_id, ()))
+
+    def online(self):
+        """
+        client_id -> number of open sessions.
+        """
+        return {client_id: len(tabs) for client_id, tabs in self._sessions.items()}
+
+    def is_online(self, client_id):
+        """
+        True while the client has a session on any process.
+        """
+        return client_id in self._sessions or client_id in self._remote
+
+    def elsewhere(self):
+        """
+        Clients only connected to other processes.
+        """
+        return [client_id for client_id in self._remote if client_id not in self._sessions]
+
+    async def join(self, client_id, conn):
+        tabs = self._sessions.get(client_id)
+        if tabs is None:
+            tabs = self._sessions[client_id] = {}
+        tabs[conn] = None
+        if len(tabs) == 1:
+            await self._announce(client_id, JOINED if client_id in self._remote else ONLINE)
+
+    async def leave(self, client_id, conn):
+        tabs = self._sessions.get(client_id)
+        if tabs is None or conn not in tabs:
+            return
+        del tabs[conn]
+        if not tabs:
+            del self._sessions[client_id]
+            await self._announce(client_id, LEFT if client_id in self._remote else OFFLINE)
+
+    def send(self, client_id, event):
+        """
+        Offers `event` to every session of `client_id`, returns how many there were.
+        """
+        tabs = self._sessions.get(client_id)
+        if not tabs:
+            return 0
+        for conn in tabs:
+            conn.offer_event(event)
+        return len(tabs)
+
+    async def _announce(self, client_id, status):
+        try:
+            await self._dispatch.submit(PresenceEvent.of(client_id, status))
+        except DispatchRejected:
+            LOG.info('presence update for %s dropped, dispatcher is full', client_id)
+
+    @subscribe(kind='PresenceEvent', remote=True)
+    async def on_presence(self, event):
+        node = key_node(event.key)
+        if node == local_node():
+            return
+        if event.status in (ONLINE, JOINED):
+            self._remote.setdefault(event.client_id, set()).add(node)
+        else:
+            nodes = self._remote.get(event.client_id)
+            if nodes is not None:
+                nodes.discard(node)
+                if not nodes:
+                    del self._remote[event.client_id]
+
+    @subscribe(kind='ErrorEvent')
+    async def on_error(self, event):
+        self.send(event.client_id, event)
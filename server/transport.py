@@ -0,0 +1,282 @@
+"""
+Transports carry shared events between the dispatchers of different processes.
+
+A transport is started with the dispatcher's `receive` callback and `publish` is
+called for every shared event submitted locally. `publish` never blocks, each
+transport buffers and writes from its own task. Events come back to the process
+that published them too, the dispatcher drops those by `Event.key`.
+
+    python transport.py broker /tmp/aiochat.sock   # runs the unix socket broker
+"""
+import abc
+import asyncio
+import logging
+import os
+import sys
+from contextlib import suppress
+
+from event import parse
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Transport(abc.ABC):
+    @abc.abstractmethod
+    async def start(self, receive):
+        pass
+
+    @abc.abstractmethod
+    def publish(self, event):
+        pass
+
+    async def close(self):
+        pass
+
+
+class InMemoryBus:
+    """
+    Connects the InMemoryTransports of several dispatchers in one process.
+    """
+    def __init__(self):
+        self.transports = []
+
+
+class InMemoryTransport(Transport):
+    """
+    Default transport. On its own bus it publishes to nobody, sharing a bus between
+    dispatchers simulates several processes.
+    """
+    def __init__(self, bus=None):
+        self.bus = bus or InMemoryBus()
+        self._receive = None
+
+    async def start(self, receive):
+        self._receive = receive
+        self.bus.transports.append(self)
+
+    def publish(self, event):
+        for transport in self.bus.transports:
+            if transport is not self:
+                transport._receive(event)
+
+    async def close(self):
+        if self in self.bus.transports:
+            self.bus.transports.remove(self)
+
+
+class _BufferedTransport(Transport):
+    """
+    Queues published events and hands them to `_send` in batches from a writer task.
+    Events encoding to more than `max_payload` bytes are dropped on their own so
+    they can't fail the rest of the batch.
+    """
+    max_payload = None
+
+    def __init__(self, max_pending=10000):
+        self._outbox = asyncio.Queue(maxsize=max_pending)
+        self._receive = None
+        self._writer = None
+        self.stats = {'published': 0, 'received': 0, 'dropped': 0, 'oversized': 0, 'errors': 0}
+
+    async def start(self, receive):
+        self._receive = receive
+        await self._connect()
+        self._writer = asyncio.create_task(self._write_forever())
+
+    def publish(self, event):
+        try:
+            self._outbox.put_nowait(event)
+        except asyncio.QueueFull:
+            self.stats['dropped'] += 1
+
+    def _deliver(self, payload):
+        event = parse(payload)
+        if event is None:
+            LOG.warning('dropping unparsable event from transport: %s', payload[:200])
+            return
+        self.stats['received'] += 1
+        self._receive(event)
+
+    async def _write_forever(self):
+        while True:
+            batch = [await self._outbox.get()]
+            while not self._outbox.empty() and len(batch) < 500:
+                batch.append(self._outbox.get_nowait())
+            payloads = self._fitting([event.to_json() for event in batch])
+            if not payloads:
+                continue
+            try:
+                await self._send(payloads)
+                self.stats['published'] += len(payloads)
+            except Exception:
+                LOG.exception('failed to publish %d events', len(payloads))
+                self.stats['errors'] += 1
+
+    def _fitting(self, payloads):
+        limit = self.max_payload
+        if limit is None:
+            return payloads
+        # a character is at most 4 bytes, only long payloads need encoding
+        fitting = [p for p in payloads if len(p) * 4 <= limit or len(p.encode()) <= limit]
+        if len(fitting) < len(payloads):
+            self.stats['oversized'] += len(payloads) - len(fitting)
+            LOG.warning('not publishing %d event(s) over %d bytes', len(payloads) - len(fitting), limit)
+        return fitting
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._writer
+            self._writer = None
+        await self._disconnect()
+
+    @abc.abstractmethod
+    async def _connect(self):
+        pass
+
+    @abc.abstractmethod
+    async def _send(self, payloads):
+        pass
+
+    async def _disconnect(self):
+        pass
+
+
+class PgNotifyTransport(_BufferedTransport):
+    """
+    Postgres LISTEN/NOTIFY over the app's asyncpg pool. One pooled connection is
+    held for LISTEN, NOTIFY payloads are capped at 8000 bytes by Postgres.
+    """
+    max_payload = 7999
+    def __init__(self, pgpool, channel='aiochat_events', **kwargs):
+        super().__init__(**kwargs)
+        self.pgpool = pgpool
+        self.channel = channel
+        self._listen_conn = None
+
+    async def _connect(self):
+        self._listen_conn = await self.pgpool.acquire()
+        await self._listen_conn.add_listener(self.channel, self._on_notify)
+
+    def _on_notify(self, conn, pid, channel, payload):
+        self._deliver(payload)
+
+    async def _send(self, payloads):
+        async with self.pgpool.acquire() as conn:
+            await conn.execute('SELECT pg_notify($1, p) FROM unnest($2::text[]) p', self.channel, payloads)
+
+    async def _disconnect(self):
+        if self._listen_conn is not None:
+            await self._listen_conn.remove_listener(self.channel, self._on_notify)
+            await self.pgpool.release(self._listen_conn)
+            self._listen_conn = None
+
+
+class UnixSocketTransport(_BufferedTransport):
+    """
+    Newline delimited JSON through a local `run_broker` process.
+    """
+    def __init__(self, path, reconnect_interval=1.0, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.reconnect_interval = reconnect_interval
+        self._reader = None
+        self._writer_stream = None
+        self._read_task = None
+
+    async def _connect(self):
+        self._reader, self._writer_stream = await asyncio.open_unix_connection(self.path)
+        self._read_task = asyncio.create_task(self._read_forever())
+
+    async def _read_forever(self):
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                LOG.warning('lost connection to broker %s, reconnecting', self.path)
+                await self._reconnect()
+                continue
+            self._deliver(line.decode())
+
+    async def _reconnect(self):
+        while True:
+            try:
+                self._reader, self._writer_stream = await asyncio.open_unix_connection(self.path)
+                return
+            except OSError:
+                await asyncio.sleep(self.reconnect_interval)
+
+    async def _send(self, payloads):
+        self._writer_stream.write(''.join(p + '\n' for p in payloads).encode())
+        await self._writer_stream.drain()
+
+    async def _disconnect(self):
+        if self._read_task is not None:
+            self._read_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._read_task
+        if self._writer_stream is not None:
+            self._writer_stream.close()
+
+
+async def run_broker(path):
+    """
+    Relays every line a client writes to all connected clients, the sender included.
+    """
+    clients = set()
+
+    async def on_client(reader, writer):
+        clients.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                for client in list(clients):
+                    try:
+                        client.write(line)
+                        if client.transport.get_write_buffer_size() > 1 << 20:
+                            await client.drain()
+                    except (ConnectionError, RuntimeError) as e:
+                        # one dead peer must not stop the relay to the others
+                        LOG.warning('broker dropping a client: %r', e)
+                        clients.discard(client)
+                        client.close()
+        finally:
+            clients.discard(writer)
+            writer.close()
+
+    with suppress(FileNotFoundError):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(on_client, path=path)
+    LOG.info('broker listening on %s', path)
+    return server
+
+
+def create_transport(config, pgpool=None):
+    """
+    Builds the transport named by config['type']: memory (default), pg or unix.
+    """
+    kind = config.get('type', 'memory')
+    if kind == 'memory':
+        return InMemoryTransport()
+    elif kind == 'pg':
+        return PgNotifyTransport(pgpool, channel=config.get('channel', 'aiochat_events'))
+    elif kind == 'unix':
+        return UnixSocketTransport(config.get('path', '/tmp/aiochat.sock'))
+    raise ValueError(f'unknown transport type {kind}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] != 'broker':
+        print('usage: python transport.py broker <socket path>')
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO)
+
+    async def _serve(path):
+        server = await run_broker(path)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(_serve(sys.argv[2]))
@@ -0,0 +1,106 @@
+import asyncio
+import json
+import pathlib
+import sys
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'server'))
+
+from broadcast import BroadcastHub
+from event import PresenceEvent
+from framing import MSGPACK
+from framing import msgpack
+from sessions import ONLINE
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class FakeWs:
+    """
+    Records what is sent, sends wait until `unblock` to play a slow consumer.
+    """
+    def __init__(self):
+        self.frames = []
+        self.closed = False
+        self._open = asyncio.Event()
+
+    def unblock(self):
+        self._open.set()
+
+    async def send_str(self, frame):
+        await self._open.wait()
+        self.frames.append(frame)
+
+    async def send_bytes(self, frame):
+        await self._open.wait()
+        self.frames.append(frame)
+
+    async def close(self):
+        self.closed = True
+
+
+async def _overflow(policy):
+    hub = BroadcastHub(max_pending=2, policy=policy)
+    ws = FakeWs()
+    conn = hub.connect(ws)
+    # the writer hasn't run, every frame stays queued
+    for frame in ('"a"', '"b"', '"c"', '"d"', '"e"'):
+        conn.offer(frame)
+    ws.unblock()
+    await asyncio.sleep(0.01)
+    return hub, ws, conn
+
+
+async def test_drop_policy_keeps_the_oldest_frames():
+    hub, ws, conn = await _overflow('drop')
+    assert ws.frames == ['"a"', '"b"']
+    assert conn.dropped == 3 and conn.sent == 2
+    await hub.close()
+
+
+async def test_coalesce_policy_sends_the_newest_frames_in_one():
+    hub, ws, conn = await _overflow('coalesce')
+    assert ws.frames == ['["d","e"]']
+    assert conn.dropped == 3 and conn.sent == 2
+    await hub.close()
+
+
+async def test_disconnect_policy_closes_the_socket():
+    hub, ws, conn = await _overflow('disconnect')
+    assert ws.closed
+    assert hub.connection_count == 0
+    assert hub.stats()['dropped'] == 1
+
+
+async def test_presence_skips_sockets_that_have_not_opened():
+    hub = BroadcastHub(policy='coalesce')
+    waiting, opened = FakeWs(), FakeWs()
+    hub.connect(waiting)
+    conn = hub.connect(opened)
+    conn.client_id = 'c'
+    for ws in (waiting, opened):
+        ws.unblock()
+    await hub.on_presence(PresenceEvent.of('other', ONLINE))
+    await asyncio.sleep(0.01)
+    assert waiting.frames == []
+    assert json.loads(opened.frames[0])['status'] == ONLINE
+    await hub.close()
+
+
+@pytest.mark.skipif(msgpack is None, reason='msgpack not installed')
+async def test_coalesce_keeps_text_and_binary_frames_apart():
+    hub = BroadcastHub(policy='coalesce')
+    ws = FakeWs()
+    conn = hub.connect(ws)
+    conn.offer('"json"')
+    conn.format = MSGPACK
+    for message in ('a', 'b'):
+        conn.offer(msgpack.packb(message))
+    ws.unblock()
+    await asyncio.sleep(0.01)
+    assert ws.frames[0] == '"json"'
+    assert msgpack.unpackb(ws.frames[1]) == ['a', 'b']
+    assert conn.sent == 3
+    await hub.close()
@@ -0,0 +1,46 @@
+import pathlib
+import sys
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'server'))
+
+from commands import CommandError
+from commands import CommandRegistry
+from commands import one_of
+from event import IntentEvent
+from event import MessageEvent
+
+
+@pytest.fixture
+def commands():
+    registry = CommandRegistry()
+    registry.declare('createBot', {'bot': one_of('QuestionBot', 'IntentRecorderBot')})
+    registry.declare('roll', {'sides': int, 'times': int})
+    registry.declare('free')
+    return registry
+
+
+def test_typed_arguments(commands):
+    assert commands.parse('.roll 6 times=2') == ('roll', [6, 2], {'sides': 6, 'times': 2})
+    assert commands.parse('.createBot bot=QuestionBot') == ('createBot', ['QuestionBot'], {'bot': 'QuestionBot'})
+    assert commands.parse('.free a b=c=d') == ('free', ['a'], {'b': 'c=d'})
+
+
+@pytest.mark.parametrize('text', ['.unknown', '.roll 6', '.roll six 2', '.roll 6 2 3', '.roll 6 2 x=1',
+                                  '.roll 6 2 sides=1', '.createBot EchoBot'])
+def test_rejected(commands, text):
+    with pytest.raises(CommandError):
+        commands.parse(text)
+
+
+def test_conflicting_schemas(commands):
+    commands.declare('free', {'x': str})
+    with pytest.raises(ValueError):
+        commands.declare('free', {'y': str})
+
+
+def test_from_message(commands):
+    intent = IntentEvent.fromMessage(MessageEvent.of('alice', '  .roll 20 1 '), commands)
+    assert (intent.client_id, intent.message, intent.action, intent.args) == ('alice', '.roll 20 1', 'roll', [20, 1])
+    assert IntentEvent.fromMessage(MessageEvent.of('alice', 'hi'), commands) is None
@@ -9,6 +9,7 @@ from pytest import fixture
 import asyncpg
 
 from server.db.orm import Table, Column,Meta
+from server.db.stub import StubConnection
 
 
 LOG = logging.getLogger(__name__)
@@ -23,6 +24,15 @@ class TData(metaclass=Meta):
     data        = Column
 
 
+class TDataPrepared(metaclass=Meta):
+    _table      = 't_data'
+    _prepare    = True
+    id          = Column(primary_key=True)
+    created     = Column(name='create_time')
+    updated     = Column(name='update_time')
+    data        = Column
+
+
 @fixture
 def config():
     config_file = os.getenv('AIO_CONFIG', None)
@@ -61,3 +71,88 @@ async def test_update_records(conn):
     updated = await saved.update(conn, data='goodbye', updated=now)
     assert updated.data == 'goodbye'
     assert updated.updated == now
+
+
+async def test_prepared_statements(conn):
+    saved = await TDataPrepared.create(conn, data='hello')
+    updated = await saved.update(conn, data='goodbye')
+    assert updated.data == 'goodbye'
+    assert len(TDataPrepared.table_meta._prepared[conn]) == 2
+
+
+async def test_prepared_statements_through_pool(conn, config):
+    pool = await asyncpg.create_pool(**config['db'], min_size=1, max_size=1)
+    try:
+        # the same connection comes back on every acquire
+        for data in ('a', 'b', 'c'):
+            async with pool.acquire() as pconn:
+                saved = await TDataPrepared.create(pconn, data=data)
+                assert (await saved.update(pconn, data=data * 2)).data == data * 2
+    finally:
+        await pool.close()
+    assert sorted(r.data for r in await TData.all(conn)) == ['aa', 'bb', 'cc']
+    await asyncio.sleep(0)
+    assert all(not c.is_closed() for c in TDataPrepared.table_meta._prepared)
+
+
+async def test_create_many_records(conn):
+    assert await TData.create_many(conn, [{'data': 'a'}, {'data': 'b'}]) is None
+    saved = await TData.create_many(conn, [{'data': 'c'}, {'data': 'd'}], returning=True)
+    assert [r.data for r in saved] == ['c', 'd']
+    assert sorted(r.data for r in await TData.all(conn)) == ['a', 'b', 'c', 'd']
+
+
+async def test_upsert_many_records(conn):
+    first = await TData.create(conn, data='hello')
+    saved = await TData.upsert_many(conn, [{'id': first.id, 'data': 'goodbye'}], returning=True)
+    assert saved[0].id == first.id
+    assert saved[0].data == 'goodbye'
+    assert len(await TData.all(conn)) == 1
+
+
+async def test_copy_in_records(conn):
+    now = datetime.datetime.now()
+    await TData.copy_in(conn, [('a', now), ('b', now)], columns=('data', 'created'))
+    records = await TData.all(conn)
+    assert sorted(r.data for r in records) == ['a', 'b']
+    assert all(r.created == now for r in records)
+
+
+async def test_iter_count_and_page(conn):
+    await TData.create_many(conn, [{'data': str(i % 3)} for i in range(10)])
+    assert await TData.count(conn) == 10
+    assert await TData.count(conn, where={'data': '0'}) == 4
+
+    streamed = [r.id async for r in TData.iter(conn, order_by='-id', batch_size=3)]
+    assert len(streamed) == 10 and streamed == sorted(streamed, reverse=True)
+    assert [r.data async for r in TData.iter(conn, where='data > $1', args=('1',))] == ['2'] * 3
+
+    ids, cursor = [], None
+    while True:
+        rows, cursor = await TData.page(conn, limit=4, after=cursor, order_by=('created', 'id'))
+        ids.extend(r.id for r in rows)
+        if cursor is None:
+            break
+    assert ids == sorted(streamed)
+
+
+class CopyRecorder(StubConnection):
+    async def copy_records_to_table(self, table_name, records, **kwargs):
+        self.copied = (table_name, records, kwargs['columns'])
+
+
+async def test_copy_in_tuples_default_to_every_column_but_the_key():
+    pg = CopyRecorder()
+    now = datetime.datetime.now()
+    await TData.copy_in(pg, [(now, now, 'a')])
+    assert pg.copied == ('t_data', [(now, now, 'a')], ['create_time', 'update_time', 'data'])
+    with pytest.raises(ValueError):
+        await TData.copy_in(pg, [(1, now, now, 'a')])
+
+
+async def test_copy_in_tuple_rows(conn):
+    now = datetime.datetime.now()
+    await TData.copy_in(conn, [(now, now, 'a'), (now, now, 'b')])
+    records = await TData.all(conn)
+    assert sorted(r.data for r in records) == ['a', 'b']
+    assert len({r.id for r in records}) == 2
@@ -0,0 +1,235 @@
+import asyncio
+import pathlib
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'server'))
+
+from bots import Bot
+from dispatch import DispatchRejected
+from dispatch import Dispatcher
+from dispatch import subscribe
+from event import MessageEvent
+from event import WsMessageEvent
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class SlowBot(Bot):
+    def __init__(self):
+        self.client_id = 'SlowBot'
+        self.calls = 0
+        self.fast = []
+        self.background = []
+
+    @subscribe(kind='MessageEvent', timeout=0.05)
+    async def on_hang(self, event):
+        self.calls += 1
+        await asyncio.sleep(10)
+
+    @subscribe(kind='MessageEvent', background=True, timeout=0)
+    async def on_background(self, event):
+        await asyncio.sleep(0.2)
+        self.background.append(event.message)
+
+    @subscribe(kind='MessageEvent')
+    async def on_fast(self, event):
+        self.fast.append(event.message)
+
+
+async def _wait_for(predicate, timeout=2.0):
+    for _ in range(int(timeout / 0.01)):
+        if predicate():
+            return
+        await asyncio.sleep(0.01)
+    assert predicate()
+
+
+async def test_hung_handler_times_out_and_trips_breaker():
+    dispatcher = Dispatcher(workers=1, breaker_threshold=2, breaker_reset=60)
+    bot = SlowBot()
+    bot.init(dispatcher)
+    dispatcher.start()
+    try:
+        for idx in range(4):
+            await dispatcher.submit(MessageEvent.of('c', str(idx)))
+        # two timeouts open the breaker, the other two events skip the hung handler
+        await _wait_for(lambda: len(bot.fast) == 4, timeout=1.0)
+        assert bot.calls == 2
+    finally:
+        await dispatcher.close()
+
+
+async def test_background_handler_does_not_hold_worker():
+    dispatcher = Dispatcher(workers=1, max_background=2)
+    bot = SlowBot()
+    bot.init(dispatcher)
+    dispatcher.start()
+    try:
+        for idx in range(3):
+            await dispatcher.submit(MessageEvent.of('c', str(idx)))
+        await _wait_for(lambda: len(bot.background) == 3)
+        assert dispatcher.stats['background_waits'] >= 1
+    finally:
+        await dispatcher.close()
+
+
+class ForwardBot(Bot):
+    def __init__(self):
+        self.client_id = 'ForwardBot'
+        self.calls = 0
+
+    @subscribe(kind='WsMessageEvent')
+    async def on_message(self, event):
+        self.calls += 1
+        # the second submit finds the one slot taken
+        await self._dispatch.submit(MessageEvent.of(event.client_id, event.message))
+        await self._dispatch.submit(MessageEvent.of(event.client_id, event.message))
+
+
+async def test_rejected_submits_do_not_trip_breaker():
+    dispatcher = Dispatcher(workers=1, max_queue=1, overload='reject', breaker_threshold=2, breaker_reset=60)
+    bot = ForwardBot()
+    bot.init(dispatcher)
+    dispatcher.start()
+    try:
+        for idx in range(5):
+            await _wait_for(lambda: dispatcher.depth == 0)
+            await dispatcher.submit(WsMessageEvent.of('c', str(idx)))
+            await _wait_for(lambda: bot.calls == idx + 1)
+        assert dispatcher.stats['rejected'] == 5
+        assert all(not route.open_until and not route.failures for route in dispatcher._iter_routes())
+    finally:
+        await dispatcher.close()
+
+
+def _queued(dispatcher):
+    return [item[0].message for lane in dispatcher._lanes for item in lane._queue]
+
+
+class Recorder(Bot):
+    def __init__(self, fan_out=0):
+        self.client_id = 'Recorder'
+        self.fan_out = fan_out
+        self.seen = []
+
+    @subscribe(kind='MessageEvent')
+    async def on_message(self, event):
+        self.seen.append(event.message)
+        if event.message.startswith('root'):
+            for idx in range(self.fan_out):
+                await self._dispatch.submit(MessageEvent.of(event.client_id, f'child {idx}'))
+
+
+@pytest.mark.parametrize('policy, queued, stat', [
+    ('drop_oldest', ['b', 'c'], 'dropped'),
+    ('drop_newest', ['a', 'b'], 'dropped'),
+])
+async def test_drop_policies_evict_one_end(policy, queued, stat):
+    # not started, nothing drains the lane
+    dispatcher = Dispatcher(workers=1, max_queue=2, overload=policy)
+    for message in 'abc':
+        await dispatcher.submit(MessageEvent.of('c', message))
+    assert _queued(dispatcher) == queued
+    assert dispatcher.stats[stat] == 1
+
+
+async def test_reject_policy_raises_and_keeps_the_queue():
+    dispatcher = Dispatcher(workers=1, max_queue=1, overload='reject')
+    await dispatcher.submit(MessageEvent.of('c', 'a'))
+    with pytest.raises(DispatchRejected):
+        await dispatcher.submit(MessageEvent.of('c', 'b'))
+    assert _queued(dispatcher) == ['a']
+    assert dispatcher.stats['rejected'] == 1
+
+
+async def test_block_policy_waits_for_room():
+    dispatcher = Dispatcher(workers=1, max_queue=1, overload='block')
+    recorder = Recorder()
+    recorder.init(dispatcher)
+    await dispatcher.submit(MessageEvent.of('c', 'a'))
+    blocked = asyncio.create_task(dispatcher.submit(MessageEvent.of('c', 'b')))
+    await asyncio.sleep(0.05)
+    assert not blocked.done()
+    dispatcher.start()
+    try:
+        await asyncio.wait_for(blocked, 1.0)
+        await _wait_for(lambda: recorder.seen == ['a', 'b'])
+        assert dispatcher.stats['dropped'] == dispatcher.stats['rejected'] == 0
+    finally:
+        await dispatcher.close()
+
+
+async def test_handler_submitting_into_full_queue_does_not_deadlock():
+    dispatcher = Dispatcher(workers=1, max_queue=1, overload='block')
+    recorder = Recorder(fan_out=5)
+    recorder.init(dispatcher)
+    dispatcher.start()
+    try:
+        await dispatcher.submit(MessageEvent.of('c', 'root'))
+        # the worker can't wait on its own lane, the puts past the first are parked
+        await _wait_for(lambda: len(recorder.seen) == 6)
+        assert sorted(recorder.seen) == ['child 0', 'child 1', 'child 2', 'child 3', 'child 4', 'root']
+    finally:
+        await dispatcher.close()
+
+
+class OrderBot(Bot):
+    def __init__(self):
+        self.client_id = 'OrderBot'
+        self.seen = {}
+
+    @subscribe(kind='MessageEvent')
+    async def on_message(self, event):
+        # uneven handler times would reorder events sharing a lane across workers
+        await asyncio.sleep(random.random() / 500)
+        self.seen.setdefault(event.client_id, []).append(int(event.message))
+
+
+async def test_sharded_lanes_keep_each_clients_order():
+    dispatcher = Dispatcher(workers=4, mode='sharded')
+    bot = OrderBot()
+    bot.init(dispatcher)
+    dispatcher.start()
+    try:
+        clients = [f'client-{idx}' for idx in range(2)]
+        for seq in range(20):
+            for client_id in clients:
+                await dispatcher.submit(MessageEvent.of(client_id, str(seq)))
+        await _wait_for(lambda: sum(map(len, bot.seen.values())) == 40)
+        assert all(bot.seen[client_id] == list(range(20)) for client_id in clients)
+    finally:
+        await dispatcher.close()
+
+
+async def test_close_drains_the_lanes():
+    dispatcher = Dispatcher(workers=1)
+    bot = OrderBot()
+    bot.init(dispatcher)
+    dispatcher.start()
+    for seq in range(20):
+        await dispatcher.submit(MessageEvent.of('c', str(seq)))
+    await dispatcher.close()
+    assert bot.seen['c'] == list(range(20))
+
+
+class PoolTimeoutBot(Bot):
+    def __init__(self):
+        self.client_id = 'PoolTimeoutBot'
+
+    @subscribe(kind='MessageEvent', timeout=5)
+    async def on_message(self, event):
+        raise TimeoutError('no connection within 2s')
+
+
+async def test_handler_timeout_errors_are_errors_not_timeouts():
+    dispatcher = Dispatcher(workers=1)
+    bot = PoolTimeoutBot()
+    bot.init(dispatcher)
+    route = next(dispatcher._iter_routes())
+    with pytest.raises(TimeoutError, match='no connection'):
+        await dispatcher._call(route, MessageEvent.of('c', 'a'))
+    assert route.errors.value == 1 and route.timeouts.value == 0
@@ -0,0 +1,44 @@
+import json
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'server'))
+
+from event import IntentEvent
+from event import KeyGenerator
+from event import MessageEvent
+from event import WsMessageEvent
+from event import key_time
+from event import parse
+from framing import COMPACT
+from framing import MSGPACK
+from framing import encode
+from framing import msgpack
+
+
+def test_keys_are_sortable_and_unique():
+    keys = KeyGenerator()
+    generated = [keys.next() for _ in range(10000)]
+    assert [k for k, _ in generated] == sorted(k for k, _ in generated)
+    assert len({k for k, _ in generated}) == len(generated)
+    assert all(key_time(k) == t for k, t in generated)
+
+
+def test_events_are_slotted():
+    event = WsMessageEvent.of('alice', 'hi')
+    assert not hasattr(event, '__dict__')
+    assert event.kind == 'WsMessageEvent' == WsMessageEvent.kind
+    assert set(event.as_dict()) == {'key', 'create_time', 'client_id', 'message', 'room_id', 'kind'}
+
+
+def test_parse_round_trip():
+    for event in (MessageEvent.of('alice', 'hi'), IntentEvent.of('alice', '.a b', 'a', ['b'], {})):
+        assert parse(event.to_json()) == event
+
+
+def test_compact_frames():
+    event = MessageEvent.of('alice', 'hi', 'red')
+    expected = {'k': event.key, 't': event.create_time, 'c': 'alice', 'm': 'hi', 'r': 'red', 'e': 'M'}
+    assert json.loads(encode(event, COMPACT)) == expected
+    if msgpack is not None:
+        assert msgpack.unpackb(encode(event, MSGPACK)) == expected
@@ -0,0 +1,82 @@
+import asyncio
+import pathlib
+import sys
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'server'))
+
+from bots import HistoryBot
+from bots import RecentHistoryBot
+from db.stub import StubPool
+from dispatch import Dispatcher
+from event import MessageEvent
+from history import format_cursor
+from history import parse_cursor
+
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_buffer_pages_through_messages_sharing_a_millisecond():
+    bot = RecentHistoryBot(None, size=10)
+    key, now = MessageEvent.of('c', 'x').key, 1_700_000_000_000
+    for idx, message in enumerate('abcd'):
+        await bot.on_message(MessageEvent(f'{key[:-6]}{idx:06x}', now, 'c', message, 'lobby'))
+
+    page = bot.query(limit=2)
+    assert [r['value'] for r in page] == ['c', 'd']
+    before = parse_cursor(format_cursor(page[0]['create_time'], page[0]['key']))
+    assert [r['value'] for r in bot.query(before=before, limit=2)] == ['a', 'b']
+    after = parse_cursor(format_cursor(page[0]['create_time'], page[0]['key']))
+    assert [r['value'] for r in bot.query(after=after, limit=2)] == ['d']
+
+
+class FlakyPool(StubPool):
+    def __init__(self, failures, delay=0):
+        super().__init__()
+        self.failures = failures
+        self.delay = delay
+        self.copied = []
+        self._conn.copy_records_to_table = self.copy
+
+    async def copy(self, table_name, records, **kwargs):
+        await asyncio.sleep(self.delay)
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('database went away')
+        self.copied.extend(records)
+
+
+async def test_failed_flush_is_retried_and_capped():
+    pool = FlakyPool(failures=2)
+    bot = HistoryBot(pool, max_pending=3)
+    for message in 'ab':
+        await bot.on_message(MessageEvent.of('c', message))
+    await bot.flush()
+    await bot.on_message(MessageEvent.of('c', 'c'))
+    await bot.on_message(MessageEvent.of('c', 'd'))
+    # the buffer is full but the last flush failed, only the flusher retries
+    assert pool.failures == 1
+    await bot.flush()
+    assert [row[1] for row in bot._buffer] == ['b', 'c', 'd']
+    assert bot.stats['failed_rows'] == 1 and bot.stats['flush_failures'] == 2
+    await bot.flush()
+    assert [row[1] for row in pool.copied] == ['b', 'c', 'd']
+    assert bot._buffer == []
+
+
+async def test_close_keeps_the_batch_being_flushed_and_the_queued_events():
+    pool = FlakyPool(failures=0, delay=0.05)
+    dispatcher = Dispatcher(workers=1)
+    bot = HistoryBot(pool, batch_size=2)
+    bot.init(dispatcher)
+    dispatcher.start()
+    for message in 'abcd':
+        await dispatcher.submit(MessageEvent.of('c', message))
+    await asyncio.sleep(0.01)
+    # the flusher is copying a and b, c and d may still be queued
+    await dispatcher.close()
+    await bot.close()
+    assert sorted(row[1] for row in pool.copied) == ['a', 'b', 'c', 'd']
+    assert bot._buffer == []
@@ -0,0 +1,77 @@
+import pathlib
+import re
+import sys
+from datetime import date
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'server'))
+
+from db import partitions
+from db.partitions import partition_name
+from db.stub import StubConnection
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class FakeConnection(StubConnection):
+    """
+    Tracks the attached partitions and the days with rows in the default one.
+    """
+    def __init__(self, days=(), default_days=()):
+        self.tables = {partition_name(day) for day in days}
+        self.default_days = set(default_days)
+        self.statements = []
+
+    async def fetch(self, sql, *args, **kwargs):
+        return [{'relname': name} for name in self.tables]
+
+    async def fetchval(self, sql, *args, **kwargs):
+        if 'to_regclass' in sql:
+            return True
+        start = date.fromisoformat(re.search(r"create_time >= '([\d-]+)'", sql).group(1))
+        return start in self.default_days
+
+    async def execute(self, sql, *args, **kwargs):
+        self.statements.append(' '.join(sql.split()))
+        created = re.search(r'CREATE TABLE (message_p\d+) PARTITION OF', sql)
+        if created:
+            self.tables.add(created.group(1))
+        dropped = re.search(r'DROP TABLE (message_p\d+)', sql)
+        if dropped:
+            self.tables.remove(dropped.group(1))
+        return 'OK'
+
+
+def _days(conn):
+    return sorted(partitions.partition_day(name) for name in conn.tables)
+
+
+async def test_drop_partitions_keeps_days_ending_after_cutoff():
+    conn = FakeConnection(days=[date(2026, 1, d) for d in (1, 2, 3, 4)])
+    dropped = await partitions.drop_partitions(conn, before=date(2026, 1, 3))
+    # Jan 2 ends at the cutoff and goes, Jan 3 still has rows newer than it
+    assert dropped == [date(2026, 1, 1), date(2026, 1, 2)]
+    assert _days(conn) == [date(2026, 1, 3), date(2026, 1, 4)]
+    assert "DELETE FROM message_default WHERE create_time < '2026-01-03'" in conn.statements
+
+
+async def test_clear_recreates_from_today_through_last_dropped():
+    today = date(2026, 1, 3)
+    conn = FakeConnection(days=[date(2026, 1, d) for d in (1, 2, 3, 4, 5)])
+    dropped = await partitions.clear(conn, today=today)
+    assert len(dropped) == 5
+    assert _days(conn) == [date(2026, 1, 3), date(2026, 1, 4), date(2026, 1, 5)]
+    assert 'TRUNCATE message_default' in conn.statements
+
+
+async def test_create_moves_rows_out_of_default_partition():
+    conn = FakeConnection(days=[date(2026, 1, 1)], default_days=[date(2026, 1, 3)])
+    created = await partitions.create_partitions(conn, date(2026, 1, 1), date(2026, 1, 3))
+    assert created == [partition_name(date(2026, 1, 2)), partition_name(date(2026, 1, 3))]
+    moves = [idx for idx, sql in enumerate(conn.statements) if 'message_moved' in sql]
+    attach = conn.statements.index(
+        "CREATE TABLE message_p20260103 PARTITION OF message FOR VALUES FROM ('2026-01-03') TO ('2026-01-04')")
+    # rows leave the default partition before the range is attached and come back after
+    assert len(moves) == 2 and moves[0] < attach < moves[1]
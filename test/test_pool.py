@@ -0,0 +1,73 @@
+import asyncio
+import pathlib
+import sys
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'server'))
+
+from db.pool import InstrumentedPool
+from db.pool import pool_options
+from metrics import Registry
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class FakePool:
+    """
+    Hands out `size` connections, the same surface InstrumentedPool uses of asyncpg's.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.idle = asyncio.Queue()
+        for idx in range(size):
+            self.idle.put_nowait(f'conn-{idx}')
+
+    async def acquire(self, timeout=None):
+        return await asyncio.wait_for(self.idle.get(), timeout)
+
+    async def release(self, conn):
+        self.idle.put_nowait(conn)
+
+    def get_size(self):
+        return self.size
+
+    def get_idle_size(self):
+        return self.idle.qsize()
+
+    def get_max_size(self):
+        return self.size
+
+
+async def test_pool_options():
+    options, timeout = pool_options({'pool': {'max_size': '20', 'statement_cache_size': 0, 'acquire_timeout': 2}})
+    assert options == {'max_size': 20, 'statement_cache_size': 0}
+    assert timeout == 2.0
+    assert pool_options({}) == ({}, None)
+
+
+async def test_acquire_wait_and_saturation():
+    registry = Registry()
+    pool = InstrumentedPool(FakePool(1), 'primary', registry=registry)
+    async with pool.acquire() as conn:
+        assert conn == 'conn-0'
+        assert pool.stats()['saturation'] == 1.0
+        waiter = asyncio.create_task(pool.acquire().__aenter__())
+        await asyncio.sleep(0.01)
+        assert pool.stats()['waiting'] == 1
+    assert await waiter == 'conn-0'
+    assert pool.stats()['waiting'] == 0
+    await pool.release('conn-0')
+    assert pool.stats()['in_use'] == 0
+    assert 'aiochat_db_pool_acquire_seconds_count{pool="primary"} 2' in registry.render()
+
+
+async def test_acquire_timeout_is_counted():
+    registry = Registry()
+    pool = InstrumentedPool(FakePool(1), 'replica', acquire_timeout=0.01, registry=registry)
+    conn = await pool.acquire()
+    with pytest.raises(asyncio.TimeoutError):
+        await pool.acquire()
+    await pool.release(conn)
+    assert 'aiochat_db_pool_acquire_timeouts_total{pool="replica"} 1' in registry.render()
@@ -0,0 +1,97 @@
+import asyncio
+import pathlib
+import sys
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'server'))
+
+from bots import Bot
+from dispatch import Dispatcher
+from dispatch import subscribe
+from event import ErrorEvent
+from event import PresenceEvent
+from sessions import SessionRegistry
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class FakeConnection:
+    def __init__(self):
+        self.frames = []
+
+    def offer_event(self, event):
+        self.frames.append(event.to_json())
+
+
+class PresenceRecorder(Bot):
+    def __init__(self):
+        self.client_id = 'PresenceRecorder'
+        self.seen = []
+
+    @subscribe(kind='PresenceEvent')
+    async def on_presence(self, event):
+        self.seen.append((event.client_id, event.status))
+
+
+async def test_presence_follows_first_and_last_session():
+    dispatcher = Dispatcher(workers=1)
+    sessions = SessionRegistry()
+    sessions.init(dispatcher)
+    recorder = PresenceRecorder()
+    recorder.init(dispatcher)
+    dispatcher.start()
+    try:
+        tab1, tab2 = FakeConnection(), FakeConnection()
+        await sessions.join('alice', tab1)
+        await sessions.join('alice', tab2)
+        assert sessions.online() == {'alice': 2}
+
+        await dispatcher.submit(ErrorEvent.of('alice', 'nope'))
+        await asyncio.sleep(0.05)
+        assert len(tab1.frames) == len(tab2.frames) == 1
+
+        await sessions.leave('alice', tab1)
+        await sessions.leave('alice', tab2)
+        await asyncio.sleep(0.05)
+        assert 'alice' not in sessions
+        assert recorder.seen == [('alice', 'online'), ('alice', 'offline')]
+    finally:
+        await dispatcher.close()
+
+
+def _remote_presence(client_id, status):
+    event = PresenceEvent.of(client_id, status)
+    # as if generated by another process
+    event.key = f'{event.key[:12]}ffffffff{event.key[20:]}'
+    return event
+
+
+async def test_presence_counts_sessions_on_other_processes():
+    dispatcher = Dispatcher(workers=1)
+    sessions = SessionRegistry()
+    sessions.init(dispatcher)
+    recorder = PresenceRecorder()
+    recorder.init(dispatcher)
+    dispatcher.start()
+    try:
+        dispatcher.receive(_remote_presence('bob', 'online'))
+        dispatcher.receive(_remote_presence('alice', 'online'))
+        await asyncio.sleep(0.05)
+        assert sessions.is_online('bob') and sessions.elsewhere() == ['bob', 'alice']
+
+        tab = FakeConnection()
+        await sessions.join('alice', tab)
+        await asyncio.sleep(0.05)
+        await sessions.leave('alice', tab)
+        await asyncio.sleep(0.05)
+        # alice still has a session on the other process
+        assert sessions.is_online('alice')
+        assert recorder.seen[-2:] == [('alice', 'joined'), ('alice', 'left')]
+
+        dispatcher.receive(_remote_presence('alice', 'offline'))
+        await asyncio.sleep(0.05)
+        assert not sessions.is_online('alice')
+    finally:
+        await dispatcher.close()
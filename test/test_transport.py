@@ -0,0 +1,182 @@
+import asyncio
+import pathlib
+import sys
+from contextlib import suppress
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'server'))
+
+from bots import Bot
+from dispatch import Dispatcher
+from dispatch import subscribe
+from event import MessageEvent
+from event import parse
+from transport import InMemoryBus
+from transport import InMemoryTransport
+from transport import UnixSocketTransport
+from transport import _BufferedTransport
+from transport import run_broker
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class Recorder(Bot):
+    def __init__(self):
+        self.client_id = 'Recorder'
+        self.local = []
+        self.remote = []
+
+    @subscribe(kind='MessageEvent')
+    async def on_local(self, event):
+        self.local.append(event.message)
+
+    @subscribe(kind='MessageEvent', remote=True)
+    async def on_any(self, event):
+        self.remote.append(event.message)
+
+
+async def _nodes(transports):
+    nodes = []
+    for transport in transports:
+        dispatcher = Dispatcher()
+        recorder = Recorder()
+        recorder.init(dispatcher)
+        await dispatcher.open(transport)
+        nodes.append((dispatcher, recorder))
+    return nodes
+
+
+async def _wait_for(predicate, timeout=2.0):
+    for _ in range(int(timeout / 0.01)):
+        if predicate():
+            return
+        await asyncio.sleep(0.01)
+    assert predicate()
+
+
+async def _close(nodes):
+    for dispatcher, _ in nodes:
+        await dispatcher.close()
+
+
+async def test_in_memory_bus_shares_events():
+    bus = InMemoryBus()
+    nodes = await _nodes([InMemoryTransport(bus), InMemoryTransport(bus)])
+    (first, first_rec), (_, second_rec) = nodes
+
+    await first.submit(MessageEvent.of('a', 'hello'))
+    await _wait_for(lambda: second_rec.remote == ['hello'])
+    assert first_rec.local == ['hello']
+    assert first_rec.remote == ['hello']
+    assert second_rec.local == []
+    await _close(nodes)
+
+
+async def test_unix_broker_shares_events_once(tmp_path):
+    path = str(tmp_path / 'broker.sock')
+    broker = await run_broker(path)
+    nodes = await _nodes([UnixSocketTransport(path), UnixSocketTransport(path)])
+    (first, first_rec), (second, second_rec) = nodes
+
+    await first.submit(MessageEvent.of('a', 'one'))
+    await second.submit(MessageEvent.of('b', 'two'))
+    await _wait_for(lambda: sorted(first_rec.remote) == ['one', 'two'] and sorted(second_rec.remote) == ['one', 'two'])
+    # each node also gets its own events back from the broker, those are dropped by key
+    await _wait_for(lambda: first.stats['duplicates'] == 1 and second.stats['duplicates'] == 1)
+    assert first_rec.local == ['one']
+    assert second_rec.local == ['two']
+
+    await _close(nodes)
+    broker.close()
+    await broker.wait_closed()
+
+
+class CapturingTransport(_BufferedTransport):
+    max_payload = 200
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    async def _connect(self):
+        pass
+
+    async def _send(self, payloads):
+        self.sent.extend(payloads)
+
+
+async def test_oversized_events_are_dropped_alone():
+    transport = CapturingTransport()
+    await transport.start(lambda event: None)
+    try:
+        for message in ('short', 'x' * 500, 'é' * 90, 'also short'):
+            transport.publish(MessageEvent.of('a', message))
+        await _wait_for(lambda: transport.stats['published'] + transport.stats['oversized'] == 4)
+        assert [parse(p).message for p in transport.sent] == ['short', 'also short']
+        assert transport.stats['oversized'] == 2
+    finally:
+        await transport.close()
+
+
+async def test_events_dropped_locally_are_not_published():
+    bus = InMemoryBus()
+    received = []
+    listener = InMemoryTransport(bus)
+    await listener.start(received.append)
+    dispatcher = Dispatcher(max_queue=1, overload='drop_newest', workers=1)
+    await dispatcher.open(InMemoryTransport(bus))
+    try:
+        # no worker has run yet, the second submit finds the lane full
+        dispatcher._tasks[0].cancel()
+        await asyncio.gather(dispatcher._tasks[0], return_exceptions=True)
+        await dispatcher.submit(MessageEvent.of('a', 'kept'))
+        await dispatcher.submit(MessageEvent.of('a', 'dropped'))
+        assert dispatcher.stats['dropped'] == 1
+        assert [e.message for e in received] == ['kept']
+    finally:
+        await dispatcher.close()
+        await listener.close()
+
+
+async def test_broker_keeps_relaying_past_a_dead_peer(tmp_path, monkeypatch):
+    path = str(tmp_path / 'broker.sock')
+    broker = await run_broker(path)
+    init, write, writers = asyncio.StreamWriter.__init__, asyncio.StreamWriter.write, []
+
+    def recording_init(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+        writers.append(self)
+
+    monkeypatch.setattr(asyncio.StreamWriter, '__init__', recording_init)
+    peers = []
+    for _ in range(3):
+        peers.append(await asyncio.open_unix_connection(path))
+        await asyncio.sleep(0.02)
+    # the broker's end of each connection, in connection order
+    relays = [w for w in writers if all(w is not p[1] for p in peers)]
+    dead = relays[1]
+
+    def failing_write(self, data):
+        if self is dead:
+            raise ConnectionResetError('peer went away')
+        return write(self, data)
+
+    monkeypatch.setattr(asyncio.StreamWriter, 'write', failing_write)
+    sender = peers[0][1]
+    for line in (b'one\n', b'two\n'):
+        write(sender, line)
+        await sender.drain()
+        await asyncio.sleep(0.05)
+
+    received = []
+    for reader, _ in peers:
+        lines = []
+        with suppress(asyncio.TimeoutError):
+            while line := await asyncio.wait_for(reader.readline(), 0.1):
+                lines.append(line)
+        received.append(lines)
+    # the dead peer was dropped, the sender's later lines still reach the others
+    assert received == [[b'one\n', b'two\n'], [], [b'one\n', b'two\n']]
+    broker.close()